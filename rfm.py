@@ -1,10 +1,37 @@
+import os
+
 import streamlit as st
 import pandas as pd
-from datetime import datetime, timedelta
-import plotly.express as px
-import plotly.graph_objects as go
-import re
-import openai
+from concurrent.futures import wait
+
+from rfm_cache import (
+    cached_auto_thresholds,
+    cached_cell_sample,
+    cached_cube,
+    cached_migration,
+    cached_monthly_revenue,
+    cached_scores,
+    cached_transactions,
+    fingerprint,
+    shared_store,
+)
+from rfm_engine import (
+    DEFAULT_THRESHOLDS,
+    OBJECTIVES,
+    Thresholds,
+    category_order,
+    cube_category_totals,
+    date_span,
+    cube_rank_means,
+    optimize_thresholds,
+    score,
+    score_cube,
+    snap_thresholds,
+)
+from rfm_instrument import Instrumentation
+from rfm_io import OUTPUT_COLUMNS
+from rfm_recommend import RecommendationError, submit_recommendation
+from rfm_recommend import WAIT_SECONDS as RECOMMENDATION_WAIT_SECONDS
 
 # Application title with colored text
 st.markdown(
@@ -15,145 +42,31 @@ st.markdown(
 )
 
 
-# Function to assign categories based on R and F scores using regex
-def assign_category(r, f):
-    rfm_score = f"{r}{f}"
-    categories = {
-        "5[4-5]": "01. Champions",
-        "[3-4][4-5]": "02. Loyal Customers",
-        "[4-5][2-3]": "03. Potential Loyalists",
-        "51": "04. Recent Customers",
-        "41": "05. Promising",
-        "33": "06. Need Attention",
-        "3[1-2]": "07. About to Sleep",
-        "[1-2][5]": "08. Can't Lose",
-        "[1-2][3-4]": "09. At Risk",
-        "2[1-2]": "10. Hibernating",
-        "1[1-2]": "11. Lost"
-    }
-    for pattern, category in categories.items():
-        if re.match(pattern, rfm_score):
-            return category
-    return "Uncategorized"
-
-
-# Define category_order
-category_order = [
-    "01. Champions",
-    "02. Loyal Customers",
-    "03. Potential Loyalists",
-    "04. Recent Customers",
-    "05. Promising",
-    "06. Need Attention",
-    "07. About to Sleep",
-    "08. Can't Lose",
-    "09. At Risk",
-    "10. Hibernating",
-    "11. Lost",
-]
-
-
-# Function to recalculate RFM values based on parameters
-def recalculate_rfm(rfm_df, recency_thresholds, frequency_thresholds, monetary_thresholds):
-    rfm_df["R_rank"] = rfm_df["Recency"].apply(
-        lambda x: next((5 - i for i, t in enumerate(recency_thresholds) if x <= t), 1)
-    )
-
-    def calculate_f_rank(frequency):
-        for i, threshold in enumerate(frequency_thresholds, start=1):
-            if frequency <= threshold:
-                return 6 - i
-        return 1
-
-    rfm_df["F_rank"] = rfm_df["Frequency"].apply(calculate_f_rank)
-
-    rfm_df["M_rank"] = rfm_df["AOS"].apply(
-        lambda x: next((5 - i for i, t in enumerate(monetary_thresholds) if x >= t), 1)
-    )
-
-    rfm_df["RFM_Score"] = rfm_df["R_rank"].astype(str) + rfm_df["F_rank"].astype(str)
-
-    rfm_df["Category"] = rfm_df.apply(
-        lambda x: assign_category(x["R_rank"], x["F_rank"]), axis=1
-    )
-
-    return rfm_df
-
-
 # Load CSV file
 csv_path = "rfm-data.csv"
-try:
-    df = pd.read_csv(csv_path)
 
-    # Convert 'date' column to datetime type
-    df["date"] = pd.to_datetime(df["date"])
+# Optional per-stage timings, shown in a sidebar expander and logged
+instrumentation = Instrumentation(st.sidebar.checkbox("Show pipeline timings", False))
+try:
+    with instrumentation.stage("load") as record:
+        source_key = fingerprint(csv_path)
+        df = cached_transactions(csv_path, source_key)
+        record["rows"] = len(df)
 
     # Create interactive date selection fields in the sidebar
-    start_date = st.sidebar.date_input("Start date", df["date"].min().date())
-    end_date = st.sidebar.date_input("End date", df["date"].max().date())
-
-    # Filter data based on selected dates
-    filtered_df = df[
-        (df["date"] >= pd.to_datetime(start_date))
-        & (df["date"] <= pd.to_datetime(end_date))
-    ]
-
-    # Calculate RFM values
-    max_date = filtered_df["date"].max() + timedelta(days=1)
-    rfm_df = (
-        filtered_df.groupby("id")
-        .agg(
-            {
-                "date": lambda x: (
-                    max_date - x.max()
-                ).days,  # Recency: days since last purchase
-                "id": "count",  # Temporary Frequency: count of purchases
-                "value": "sum",  # Monetary: total value of purchases
-            }
-        )
-        .rename(
-            columns={
-                "date": "Recency",
-                "id": "Temp_Frequency",  # Temporary frequency, count of purchases
-                "value": "Monetary",
-            }
-        )
-        .reset_index()
-    )
+    first_date, last_date = date_span(df)
+    start_date = st.sidebar.date_input("Start date", first_date.date())
+    end_date = st.sidebar.date_input("End date", last_date.date())
 
-    # Calculate Frequency as number of days between the first and last purchase / number of purchases
-    frequency_df = (
-        filtered_df.groupby("id")
-        .agg(
-            {
-                "date": lambda x: max(
-                    (x.max() - x.min()).days / len(x), 1
-                )  # Ensure frequency is at least 1
-            }
-        )
-        .rename(columns={"date": "Frequency"})
-        .reset_index()
-    )
-
-    # Merge the frequency calculation back into the RFM dataframe
-    rfm_df = rfm_df.drop(columns=["Temp_Frequency"]).merge(frequency_df, on="id")
-
-    # Calculate Average Order Size (AOS)
-    rfm_df["AOS"] = rfm_df.apply(
-        lambda x: (
-            x["Monetary"] / x["Frequency"]
-            if pd.notna(x["Frequency"]) and x["Frequency"] != 0
-            else 0
-        ),
-        axis=1,
-    )
-
-    # Initial RFM calculation with default parameters
-    recency_thresholds = [3, 10, 25, 66]
-    frequency_thresholds = [13.6, 24.5, 38.8, 66.6]
-    monetary_thresholds = [6841, 3079, 1573, 672]
+    # Default thresholds, or quintile boundaries derived from the selected window
+    thresholds = DEFAULT_THRESHOLDS
+    if st.sidebar.checkbox("Auto thresholds (quintiles)", False):
+        with instrumentation.stage("auto thresholds"):
+            thresholds = cached_auto_thresholds(csv_path, source_key, start_date, end_date)
 
-    rfm_df = recalculate_rfm(rfm_df, recency_thresholds, frequency_thresholds, monetary_thresholds)
+    with instrumentation.stage("rfm + score") as record:
+        rfm_df = cached_scores(csv_path, source_key, start_date, end_date, thresholds)
+        record["rows"] = len(rfm_df)
 
     # CSS for styling buttons
     st.markdown(
@@ -187,13 +100,14 @@ try:
         ("About Customers", "About Customers"),
         ("About Segmentation", "About Segmentation"),
         ("RFM Tuning", "RFM Tuning"),
+        ("Segment Migration", "Segment Migration"),
         ("Recommended Strategy", "TO DO Analysis"),
     ]
 
     selected_button = None
 
     # Create columns for buttons to be displayed in rows
-    row1 = st.columns(4)
+    row1 = st.columns(5)
 
     rows = [row1]
 
@@ -202,41 +116,35 @@ try:
             if col.button(button_text, key=button_value):
                 selected_button = button_value
 
-    # Display the graph based on the selected button
+    # Display the graph based on the selected button; the view is kept in the
+    # session so widgets inside a view (e.g. the period slider) don't reset it
     if selected_button is None:
-        selected_button = "About Segmentation"
+        selected_button = st.session_state.get("selected_view", "About Segmentation")
+    st.session_state["selected_view"] = selected_button
 
     # Filter data based on the selected categories
     filtered_category_df = rfm_df
 
+    # Time the selected view, including building its figures
+    view_record = instrumentation.begin(f"view: {selected_button}", len(rfm_df))
+
     if selected_button == "About Customers":
-        # Add 'Category' column to filtered_df
-        filtered_df = filtered_df.merge(rfm_df[["id", "Category"]], on="id", how="left")
+        # Chart libraries are imported only by the views that draw charts
+        import plotly.express as px
+        import plotly.graph_objects as go
 
-        # Monthly revenue over time with stacked bar plot by category
-        monthly_revenue = (
-            filtered_df.set_index("date").resample("M")["value"].sum().reset_index()
-        )
+        from rfm_charts import box_figure
 
-        # Ensure all categories are present
-        category_monthly_revenue = (
-            filtered_df.groupby([pd.Grouper(key="date", freq="M"), "Category"])["value"]
-            .sum()
-            .unstack()
-            .fillna(0)
+        # Monthly revenue in total and by category for the selected window
+        monthly_revenue, category_monthly_revenue = cached_monthly_revenue(
+            csv_path, source_key, start_date, end_date, thresholds
         )
-        for category in category_order:
-            if category not in category_monthly_revenue.columns:
-                category_monthly_revenue[category] = 0
-
-        # Sort columns by category_order
-        category_monthly_revenue = category_monthly_revenue[category_order]
 
         fig3 = go.Figure()
         fig3.add_trace(
             go.Scatter(
-                x=monthly_revenue["date"],
-                y=monthly_revenue["value"],
+                x=monthly_revenue.index,
+                y=monthly_revenue.values,
                 mode="lines",
                 name="Total Revenue",
             )
@@ -268,7 +176,6 @@ try:
         )
 
         # Average Order Size by Category
-        rfm_df["AOS"] = rfm_df["Monetary"] / rfm_df["Frequency"]
         aos_df = rfm_df.groupby("Category").agg({"AOS": "mean"}).reset_index()
         fig = px.bar(
             aos_df,
@@ -281,28 +188,14 @@ try:
         )
         st.plotly_chart(fig)
 
-        fig2 = px.box(
-            filtered_category_df,
-            y="Recency",
-            title="Boxplot Recency",
-            color="Category",
-            category_orders={"Category": category_order},
-            color_discrete_sequence=px.colors.qualitative.Pastel,
-        )
+        fig2 = box_figure(filtered_category_df, "Recency", "Boxplot Recency")
         st.plotly_chart(fig2)
         st.markdown(
             "<p style='font-size: small;'>Recency shows how recently each customer made a purchase.</p>",
             unsafe_allow_html=True,
         )
 
-        fig2 = px.box(
-            filtered_category_df,
-            y="Frequency",
-            title="Boxplot Frequency",
-            color="Category",
-            category_orders={"Category": category_order},
-            color_discrete_sequence=px.colors.qualitative.Pastel,
-        )
+        fig2 = box_figure(filtered_category_df, "Frequency", "Boxplot Frequency")
         st.plotly_chart(fig2)
         st.markdown(
             "<p style='font-size: small;'>Frequency shows how often each customer makes a purchase.</p>",
@@ -314,14 +207,7 @@ try:
             filtered_category_df["Monetary"]
             <= filtered_category_df["Monetary"].quantile(0.95)
         ]
-        fig2 = px.box(
-            filtered_monetary_df,
-            y="Monetary",
-            title="Boxplot Monetary",
-            color="Category",
-            category_orders={"Category": category_order},
-            color_discrete_sequence=px.colors.qualitative.Pastel,
-        )
+        fig2 = box_figure(filtered_monetary_df, "Monetary", "Boxplot Monetary")
         st.plotly_chart(fig2)
         st.markdown(
             "<p style='font-size: small;'>Monetary shows how much money each customer spends.</p>",
@@ -329,6 +215,8 @@ try:
         )
 
     if selected_button == "About Segmentation":
+        import plotly.express as px
+
         # Customizing the display for "About Segmentation"
         fig1 = px.treemap(
             rfm_df,
@@ -377,59 +265,131 @@ try:
         st.plotly_chart(fig2)
 
     if selected_button == "RFM Tuning":
+        import plotly.express as px
+        import plotly.graph_objects as go
+
+        # Optimizer mode: search R/F thresholds on the tuning cube and fill
+        # the best set into the parameters below
+        optimizer_key = (source_key, start_date, end_date, thresholds)
+        with st.sidebar.expander("Threshold Optimizer"):
+            objective = st.selectbox(
+                "Objective",
+                list(OBJECTIVES),
+                format_func=lambda name: {
+                    "balanced": "Balanced segment sizes",
+                    "champions_revenue": "Champions revenue share",
+                }.get(name, name),
+            )
+            target = 0.5
+            if objective == "champions_revenue":
+                target = st.slider("Champions revenue share target", 0.05, 0.95, 0.5, 0.05)
+            n_candidates = int(
+                st.number_input("Candidates", 1000, 1_000_000, 20000, step=1000)
+            )
+            parallel = st.checkbox("Evaluate in parallel", False)
+            if st.button("Optimize thresholds"):
+                with instrumentation.stage("optimize thresholds", n_candidates):
+                    optimized, loss = optimize_thresholds(
+                        cached_cube(csv_path, source_key, start_date, end_date),
+                        objective,
+                        target,
+                        n_candidates,
+                        workers=(os.cpu_count() or 1) if parallel else 1,
+                        monetary=thresholds.monetary,
+                    )
+                st.session_state["optimized_thresholds"] = (optimizer_key, optimized)
+                st.write(f"Best loss: {loss:.4f}")
+            if st.button("Reset thresholds"):
+                st.session_state.pop("optimized_thresholds", None)
+
+        # An optimized set only applies to the data, window and base thresholds
+        # it was searched for; any change drops it
+        stored = st.session_state.get("optimized_thresholds")
+        if stored is not None and stored[0] != optimizer_key:
+            st.session_state.pop("optimized_thresholds")
+        elif stored is not None:
+            thresholds = stored[1]
+
         with st.sidebar.expander("RFM Parameters", expanded=True):
             st.markdown("### Recency Parameters")
             col1, col2, col3, col4 = st.columns(4)
             with col1:
-                r5 = int(st.text_input("R5", 3))
+                r5 = int(st.text_input("R5", thresholds.recency[0]))
             with col2:
-                r4 = int(st.text_input("R4", 10))
+                r4 = int(st.text_input("R4", thresholds.recency[1]))
             with col3:
-                r3 = int(st.text_input("R3", 25))
+                r3 = int(st.text_input("R3", thresholds.recency[2]))
             with col4:
-                r2 = int(st.text_input("R2", 66))
+                r2 = int(st.text_input("R2", thresholds.recency[3]))
 
             st.markdown("")
             with col1:
-                f5 = float(st.text_input("F5", 13.6))
+                f5 = float(st.text_input("F5", thresholds.frequency[0]))
             with col2:
-                f4 = float(st.text_input("F4", 24.5))
+                f4 = float(st.text_input("F4", thresholds.frequency[1]))
             with col3:
-                f3 = float(st.text_input("F3", 38.8))
+                f3 = float(st.text_input("F3", thresholds.frequency[2]))
             with col4:
-                f2 = float(st.text_input("F2", 66.6))
+                f2 = float(st.text_input("F2", thresholds.frequency[3]))
 
             st.markdown("")
             with col1:
-                m5 = float(st.text_input("M5", 6841))
+                m5 = float(st.text_input("M5", thresholds.monetary[0]))
             with col2:
-                m4 = float(st.text_input("M4", 3079))
+                m4 = float(st.text_input("M4", thresholds.monetary[1]))
             with col3:
-                m3 = float(st.text_input("M3", 1573))
+                m3 = float(st.text_input("M3", thresholds.monetary[2]))
             with col4:
-                m2 = float(st.text_input("M2", 672))
+                m2 = float(st.text_input("M2", thresholds.monetary[3]))
 
-        if "rfm_df" in locals():
-            # Recalculate ranks based on updated parameters
-            rfm_df = recalculate_rfm(
-                rfm_df, [r5, r4, r3, r2], [f5, f4, f3, f2], [m5, m4, m3, m2]
+        # F thresholds are rounded to the cube's Frequency grid so the counts
+        # below match a full rescoring exactly
+        tuned_thresholds = snap_thresholds(
+            Thresholds((r5, r4, r3, r2), (f5, f4, f3, f2), (m5, m4, m3, m2))
+        )
+        if tuned_thresholds.frequency != (f5, f4, f3, f2):
+            st.sidebar.caption(
+                "F thresholds rounded to "
+                + ", ".join(f"{t:g}" for t in tuned_thresholds.frequency)
             )
 
-            st.success("RFM segmentation updated!")
+        # Threshold edits are evaluated on the precomputed (Recency, Frequency)
+        # cube; customers are rescored in full only for an export
+        cube = score_cube(
+            cached_cube(csv_path, source_key, start_date, end_date), tuned_thresholds
+        )
+        category_totals = cube_category_totals(cube)
+
+        st.success("RFM segmentation updated!")
 
         # Display the number of customers in each category
         st.markdown("### Number of Customers in Each Category")
-        category_counts = (
-            rfm_df["Category"].value_counts().reindex(category_order).reset_index()
+        category_counts = category_totals[["Category", "Customers"]].rename(
+            columns={"Customers": "Number of Customers"}
         )
-        category_counts.columns = ["Category", "Number of Customers"]
         st.dataframe(category_counts)
 
         # Display the updated RFM dataframe
-        st.dataframe(rfm_df.head())
+        st.dataframe(score(rfm_df.head(), tuned_thresholds))
+
+        if st.button("Export segments"):
+            export_df = cached_scores(
+                csv_path, source_key, start_date, end_date, tuned_thresholds, slot="export"
+            )
+            st.download_button(
+                "Download segments CSV",
+                export_df[OUTPUT_COLUMNS].to_csv(index=False),
+                file_name="rfm_segments.csv",
+                mime="text/csv",
+            )
 
+        # The cached sample has a customer in every cube cell, so scoring just
+        # the sample keeps the payload bounded and every tuned category visible
+        scatter_df = score(
+            cached_cell_sample(csv_path, source_key, start_date, end_date), tuned_thresholds
+        )
         fig = px.scatter_3d(
-            filtered_category_df,
+            scatter_df,
             x="Recency",
             y="Frequency",
             z="Monetary",
@@ -441,18 +401,15 @@ try:
         )  # Increase height for better visualization
         fig.update_traces(marker=dict(size=5))  # Adjust marker size
         st.plotly_chart(fig)
+        if len(scatter_df) < len(rfm_df):
+            st.markdown(
+                f"<p style='font-size: small;'>Showing a stratified sample of {len(scatter_df)} of {len(rfm_df)} customers.</p>",
+                unsafe_allow_html=True,
+            )
 
         # Pareto Chart
-        filtered_category_df_sorted = filtered_category_df.sort_values(
-            "Monetary", ascending=False
-        )
-
         # Aggregating data into 11 categories for readability
-        aggregated_df = (
-            filtered_category_df_sorted.groupby("Category")
-            .agg({"Monetary": "sum"})
-            .reset_index()
-        )
+        aggregated_df = category_totals[category_totals["Customers"] > 0].copy()
 
         # Calculate the percentage of total revenue for each category
         total_revenue = aggregated_df["Monetary"].sum()
@@ -511,9 +468,7 @@ try:
 
         # Heatmap R & F
         # Calculate average order size (AOS) for each R and F combination
-        heatmap_data = rfm_df.pivot_table(
-            index="R_rank", columns="F_rank", values="AOS", aggfunc="mean"
-        ).fillna(0)
+        heatmap_data = cube_rank_means(cube)
 
         # Create the heatmap
         fig = px.imshow(
@@ -528,149 +483,97 @@ try:
 
         st.plotly_chart(fig)
 
-    if selected_button == "TO DO Analysis":
-        st.markdown("## Recommended Strategy")
-    
-        # Function to get recommendation from OpenAI
-        def get_recommendation():
-            try:
-                openai.api_key = st.secrets["OPENAI_TOKEN"]
-                st.write("OpenAI token loaded successfully.")
-            except KeyError as e:
-                st.error(f"Error loading OpenAI token: {e}")
-                return None
-    
-            # Convert the filtered data frame to a CSV string
-            filtered_data_str = filtered_category_df.head(100).to_csv(index=False)  # Send only first 100 rows
-    
-            prompt = (
-                f"Based on the RFM analysis, provide a detailed and comprehensive description of the customers across all 11 segments. You are data analyst with perfect business feeling. "
-                f"Analyze each segment individually, following this specific category order and structure:\n\n"
-                
-                f"Champions:\n"
-                f"Customer Value:\n"
-                f"    1 key sentence about this category business\n"
-                f"Engagement Recommendations:\n"
-                f"    Provide 2 key recommendations on how to engage with Champions.\n\n"
-                
-                f"Loyal Customers:\n"
-                f"Customer Value:\n"
-                f"    1 key sentence about this category business\n"
-                f"Engagement Recommendations:\n"
-                f"    Provide 2 key recommendations on how to engage with Loyal Customers.\n\n"
-                
-                f"Potential Loyalists:\n"
-                f"Customer Value:\n"
-                f"    1 key sentence about this category business\n"
-                f"Engagement Recommendations:\n"
-                f"    Provide 2 key recommendations on how to engage with Potential Loyalists.\n\n"
-                
-                f"Recent Customers:\n"
-                f"Customer Value:\n"
-                f"    1 key sentence about this category business\n"
-                f"Engagement Recommendations:\n"
-                f"    Provide 2 key recommendations on how to engage with Recent Customers.\n\n"
-                
-                f"Promising:\n"
-                f"Customer Value:\n"
-                f"    1 key sentence about this category business\n"
-                f"Engagement Recommendations:\n"
-                f"    Provide 2 key recommendations on how to engage with Promising customers.\n\n"
-                
-                f"Need Attention:\n"
-                f"Customer Value:\n"
-                f"    1 key sentence about this category business\n"
-                f"Engagement Recommendations:\n"
-                f"    Provide 2 key recommendations on how to engage with customers who Need Attention.\n\n"
-                
-                f"About to Sleep:\n"
-                f"Customer Value:\n"
-                f"    1 key sentence about this category business\n"
-                f"Engagement Recommendations:\n"
-                f"    Provide 2 key recommendations on how to engage with customers who are About to Sleep.\n\n"
-                
-                f"Can't Lose:\n"
-                f"Customer Value:\n"
-                f"    1 key sentence about this category business\n"
-                f"Engagement Recommendations:\n"
-                f"    Provide 2 key recommendations on how to engage with customers who Can't Lose.\n\n"
-                
-                f"At Risk:\n"
-                f"Customer Value:\n"
-                f"    1 key sentence about this category business\n"
-                f"Engagement Recommendations:\n"
-                f"    Provide 2 key recommendations on how to engage with customers who are At Risk.\n\n"
-                
-                f"Hibernating:\n"
-                f"Customer Value:\n"
-                f"    1 key sentence about this category business\n"
-                f"Engagement Recommendations:\n"
-                f"    Provide 2 key recommendations on how to engage with Hibernating customers.\n\n"
-                
-                f"Lost:\n"
-                f"Customer Value:\n"
-                f"    1 key sentence about this category business\n"
-                f"Engagement Recommendations:\n"
-                f"    Provide 2 key recommendations on how to engage with Lost customers.\n\n"
-
-                f"! Make all names of Category bold\n"
-                f"! Make all names like customer value and engagement recommendations bold\n"
-                f"! Didnt use word RFM skore\n"
-                f"! Follow the structure\n"
-
-                f"Here is the data:\n{filtered_data_str}"
-            )
+    if selected_button == "Segment Migration":
+        import plotly.express as px
 
+        # Month-end snapshots of the selected window with the current thresholds
+        sizes, matrices = cached_migration(
+            csv_path, source_key, start_date, end_date, thresholds
+        )
 
+        # Number of customers in each category at every as-of date
+        sizes_df = sizes.reset_index().melt(
+            id_vars="As of", var_name="Category", value_name="Number of Customers"
+        )
+        fig = px.bar(
+            sizes_df,
+            x="As of",
+            y="Number of Customers",
+            color="Category",
+            title="Customers by Category Over Time",
+            category_orders={"Category": category_order},
+            color_discrete_sequence=px.colors.qualitative.Pastel,
+        )
+        st.plotly_chart(fig)
 
-    
-            try:
-                response = openai.ChatCompletion.create(
-                    model="gpt-3.5-turbo-16k",
-                    messages=[
-                        {"role": "system", "content": "You are a data analyst."},
-                        {"role": "user", "content": prompt},
-                    ],
-                    max_tokens=1000,  # Increase the number of max tokens
-                    temperature=0.7,  # Adjust the temperature for more creative responses
-                )
-                # Kontrola struktury odpovědi
-                if 'choices' in response and len(response['choices']) > 0:
-                    return response['choices'][0]['message']['content'].strip()
-                else:
-                    st.error("Unexpected API response structure")
-                    return None
-            except openai.error.RateLimitError:
-                st.error(
-                    "You have exceeded your OpenAI API quota. Please check your plan and billing details."
-                )
-                return None
-            except openai.error.PermissionError:
-                st.error(
-                    "You have insufficient permissions for this operation. Please check your API key permissions."
-                )
-                return None
-            except Exception as e:
-                st.error(f"Error with OpenAI request: {e}")
-                return None
+        if matrices:
+            # Transition matrix of the selected period
+            periods = [f"{start:%Y-%m-%d} → {end:%Y-%m-%d}" for start, end, _ in matrices]
+            period = st.select_slider("Period", options=periods, value=periods[-1])
+            matrix = matrices[periods.index(period)][2]
+
+            fig = px.imshow(
+                matrix,
+                title=f"Segment Migration {period}",
+                color_continuous_scale="Blues",
+                text_auto=True,
+                aspect="auto",
+                labels={"color": "Customers"},
+            )
+            fig.update_layout(xaxis_title="To Category", yaxis_title="From Category", height=700)
+            st.plotly_chart(fig)
+            st.markdown(
+                "<p style='font-size: small;'>Each cell counts the customers moving from one category at the start of the period to another at its end; \"(new)\" are customers whose first purchase falls within the period.</p>",
+                unsafe_allow_html=True,
+            )
+        else:
+            st.info("Select a window spanning more than one month to see migrations.")
+
+    if selected_button == "TO DO Analysis":
+        st.markdown("## Recommended Strategy")
     
         try:
-            recommendation = get_recommendation()
-            if recommendation:
-                st.markdown(recommendation)
+            api_key = st.secrets["OPENAI_TOKEN"]
+            st.write("OpenAI token loaded successfully.")
+
+            # The request runs in the background; answers are cached on disk
+            future = submit_recommendation(filtered_category_df, api_key)
+            with st.spinner("Generating recommendation..."):
+                done, _ = wait([future], timeout=RECOMMENDATION_WAIT_SECONDS)
+
+            if done:
+                st.markdown(future.result())
             else:
-                st.write(
-                    "No recommendation received. This feature may be temporarily unavailable due to API quota limits."
+                st.info(
+                    "The recommendation is still being generated. Click \"Recommended Strategy\" again in a moment."
                 )
         except KeyError as e:
             st.error(f"Error loading OpenAI token: {e}")
+        except RecommendationError as e:
+            st.error(str(e))
+            st.write(
+                "No recommendation received. This feature may be temporarily unavailable due to API quota limits."
+            )
         except Exception as e:
             st.error(f"An error occurred: {e}")
             st.write("This feature is temporarily unavailable due to API quota limits.")
 
+    instrumentation.end(view_record)
+
+    # Debug panel with the timings recorded during this run
+    if instrumentation.enabled:
+        with st.sidebar.expander("Pipeline timings", expanded=True):
+            st.dataframe(pd.DataFrame(instrumentation.records))
+            shared = shared_store().stats()
+            st.caption(
+                f"Shared store: {len(shared)} entries, {sum(shared.values())} session references"
+            )
 
 
 except FileNotFoundError:
     st.error(f"File not found at path {csv_path}.")
 except Exception as e:
     st.error(f"An error occurred while loading the file: {e}")
+finally:
+    # Memory tracing is process-wide; release it even when a view fails
+    instrumentation.stop()
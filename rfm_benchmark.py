@@ -0,0 +1,164 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from rfm_engine import (
+    DEFAULT_THRESHOLDS,
+    assign_categories,
+    assign_ranks,
+    box_stats,
+    compute_rfm,
+    filter_transactions,
+    histogram_counts,
+    sample_by_category,
+    segment_profile,
+)
+from rfm_io import parse_transactions
+
+# Benchmark harness for the RFM pipeline. Generates a seeded synthetic
+# transaction file with the id,date,num_of_events,value schema, times every
+# stage separately and saves the results as JSON for comparison across commits.
+#
+#   python rfm_benchmark.py --customers 100000 --transactions 5000000 --output bench.json
+
+
+# Function to generate synthetic transactions sorted by date like the export.
+# Customer activity is skewed (a few customers buy much more often) and order
+# values are log-normal.
+def generate_transactions(customers, transactions, days=730, start="2022-01-01", seed=0):
+    rng = np.random.default_rng(seed)
+    weights = rng.pareto(1.5, customers) + 1
+    ids = rng.choice(
+        np.arange(10_000, 10_000 + customers), size=transactions, p=weights / weights.sum()
+    )
+    offsets = np.sort(rng.integers(0, days, transactions))
+    dates = np.datetime64(start) + offsets.astype("timedelta64[D]")
+    return pd.DataFrame(
+        {
+            "id": ids,
+            "date": np.datetime_as_string(dates, unit="D"),
+            "num_of_events": rng.poisson(2, transactions) + 1,
+            "value": np.round(rng.lognormal(5, 1.2, transactions), 2),
+        }
+    )
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    # Function to time one stage and record its wall time and row count
+    def run(self, name, function, *args, rows=None):
+        start = time.perf_counter()
+        result = function(*args)
+        self.stages[name] = {
+            "seconds": round(time.perf_counter() - start, 6),
+            "rows": len(result) if rows is None else rows,
+        }
+        return result
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _prepare_chart_data(scores):
+    for column in ("Recency", "Frequency", "Monetary"):
+        box_stats(scores, column)
+        histogram_counts(scores, column)
+    segment_profile(scores)
+    return sample_by_category(scores)
+
+
+# Function to run every pipeline stage on a CSV file and return the timings
+def run_benchmark(csv_path, start_date=None, end_date=None, thresholds=DEFAULT_THRESHOLDS):
+    timer = StageTimer()
+    df = timer.run("load", pd.read_csv, csv_path)
+
+    df = timer.run("date_parse", parse_transactions, df)
+    window = timer.run("filter", filter_transactions, df, start_date, end_date)
+    rfm_df = timer.run("aggregate", compute_rfm, window)
+    ranked = timer.run("rank", assign_ranks, rfm_df, thresholds)
+
+    def categorize(ranked):
+        ranked["Category"] = assign_categories(ranked["R_rank"], ranked["F_rank"])
+        return ranked
+
+    scores = timer.run("categorize", categorize, ranked)
+    timer.run("chart_data", _prepare_chart_data, scores, rows=len(scores))
+    return timer.stages
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the RFM pipeline.")
+    parser.add_argument("--customers", type=int, default=100_000)
+    parser.add_argument("--transactions", type=int, default=1_000_000)
+    parser.add_argument("--days", type=int, default=730)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--start-date", help="window start for the filter stage")
+    parser.add_argument("--end-date", help="window end for the filter stage")
+    parser.add_argument("--input", help="benchmark an existing CSV instead of synthetic data")
+    parser.add_argument("--output", help="JSON file for the results (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    params = {
+        "customers": args.customers,
+        "transactions": args.transactions,
+        "days": args.days,
+        "seed": args.seed,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = args.input
+        if csv_path is None:
+            csv_path = os.path.join(tmp, "transactions.csv")
+            generate_transactions(
+                args.customers, args.transactions, args.days, seed=args.seed
+            ).to_csv(csv_path, index=False)
+        else:
+            params = {"input": os.path.abspath(csv_path)}
+        params["window"] = [args.start_date, args.end_date]
+        stages = run_benchmark(csv_path, args.start_date, args.end_date)
+
+    results = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "params": params,
+        "stages": stages,
+        "total_seconds": round(sum(stage["seconds"] for stage in stages.values()), 6),
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
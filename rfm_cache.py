@@ -0,0 +1,114 @@
+import os
+
+import streamlit as st
+
+from rfm_engine import (
+    WindowIndex,
+    auto_thresholds,
+    filter_transactions,
+    month_ends,
+    monthly_revenue_by_category,
+    rfm_cube,
+    sample_by_cell,
+    score,
+    segment_migration,
+)
+from rfm_io import load_transactions, source_fingerprint
+from rfm_store import SessionHandles, SharedStore
+
+# Streamlit memoization of the pipeline stages. Each stage is cached on its
+# real inputs (source fingerprint, date window, thresholds) and the caches are
+# bounded so a shared server keeps a fixed number of entries per stage.
+# Per-customer and per-transaction tables live in a process-wide SharedStore:
+# sessions hold references to them instead of their own copies, so they must
+# not be modified in place.
+
+CACHE_MAX_ENTRIES = int(os.environ.get("RFM_CACHE_MAX_ENTRIES", 16))
+CACHE_TTL_SECONDS = int(os.environ.get("RFM_CACHE_TTL_SECONDS", 3600))
+
+
+# Function to key the cache on the current state of the source file
+def fingerprint(csv_path):
+    return tuple(sorted(source_fingerprint(csv_path).items()))
+
+
+# One store per server process, shared by every session
+@st.cache_resource(show_spinner=False)
+def shared_store():
+    return SharedStore()
+
+
+# Function to get this session's references into the shared store; they are
+# released when the session ends
+def session_handles():
+    if "rfm_shared" not in st.session_state:
+        st.session_state["rfm_shared"] = SessionHandles(shared_store())
+    return st.session_state["rfm_shared"]
+
+
+# Transactions of the source file, one read-only copy per process
+def cached_transactions(csv_path, source_key):
+    return session_handles().get(
+        "transactions",
+        ("transactions", csv_path, source_key),
+        lambda: load_transactions(csv_path),
+    )
+
+
+# The window index is shared across sessions rather than copied per call
+@st.cache_resource(max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def cached_window_index(csv_path, source_key):
+    return WindowIndex(cached_transactions(csv_path, source_key))
+
+
+# RFM table of a window straight from the shared index; the stages built on
+# it are cached, so the table itself isn't kept
+def cached_rfm(csv_path, source_key, start_date, end_date):
+    return cached_window_index(csv_path, source_key).rfm(start_date, end_date)
+
+
+# Scored RFM table of a window and threshold set, shared by the sessions
+# looking at it. A session holds one table per slot, so e.g. an export can
+# be scored next to the table on screen.
+def cached_scores(csv_path, source_key, start_date, end_date, thresholds, slot="scores"):
+    return session_handles().get(
+        slot,
+        ("scores", csv_path, source_key, start_date, end_date, thresholds),
+        lambda: score(cached_rfm(csv_path, source_key, start_date, end_date), thresholds),
+    )
+
+
+# Tuning cube of the window; threshold edits are evaluated on it, not on customers
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def cached_cube(csv_path, source_key, start_date, end_date):
+    return rfm_cube(cached_rfm(csv_path, source_key, start_date, end_date))
+
+
+# Scatter sample of the window with a customer in every cube cell; only this
+# sample is rescored when the tuning thresholds change
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def cached_cell_sample(csv_path, source_key, start_date, end_date):
+    return sample_by_cell(cached_rfm(csv_path, source_key, start_date, end_date))
+
+
+# Quintile thresholds are cached alongside the RFM table of the same window
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def cached_auto_thresholds(csv_path, source_key, start_date, end_date):
+    return auto_thresholds(cached_rfm(csv_path, source_key, start_date, end_date))
+
+
+# Monthly segment snapshots of the window, all served by the shared window index
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def cached_migration(csv_path, source_key, start_date, end_date, thresholds):
+    index = cached_window_index(csv_path, source_key)
+    as_of_dates = month_ends(start_date, end_date)
+    return segment_migration(index, as_of_dates, thresholds, start_date=start_date)
+
+
+# Monthly revenue per category of the window, cached per window and thresholds
+@st.cache_data(max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def cached_monthly_revenue(csv_path, source_key, start_date, end_date, thresholds):
+    return monthly_revenue_by_category(
+        filter_transactions(cached_transactions(csv_path, source_key), start_date, end_date),
+        cached_scores(csv_path, source_key, start_date, end_date, thresholds),
+    )
@@ -0,0 +1,68 @@
+import plotly.express as px
+import plotly.graph_objects as go
+
+from rfm_engine import box_stats, category_order, histogram_counts
+
+# Plotly figures built from per-Category aggregates computed server-side,
+# so the payload size depends on the number of categories, not customers.
+
+
+# Function to pick the Pastel color of a category by its position in category_order
+def category_color(category):
+    palette = px.colors.qualitative.Pastel
+    if category in category_order:
+        return palette[category_order.index(category) % len(palette)]
+    return palette[-1]
+
+
+# Function to build a per-Category box plot from precomputed quartiles and whiskers
+def box_figure(rfm_df, column, title):
+    stats = box_stats(rfm_df, column)
+    fig = go.Figure()
+    for row in stats.itertuples(index=False):
+        fig.add_trace(
+            go.Box(
+                name=row.Category,
+                x=[row.Category],
+                q1=[row.q1],
+                median=[row.median],
+                q3=[row.q3],
+                mean=[row.mean],
+                lowerfence=[row.lowerfence],
+                upperfence=[row.upperfence],
+                marker_color=category_color(row.Category),
+            )
+        )
+    fig.update_layout(
+        title=title,
+        yaxis_title=column,
+        legend_title_text="Category",
+        xaxis=dict(showticklabels=False),
+    )
+    return fig
+
+
+# Function to build a stacked per-Category histogram from precomputed bin counts
+def histogram_figure(rfm_df, column, title, bins=50):
+    edges, counts = histogram_counts(rfm_df, column, bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    fig = go.Figure()
+    for category, row in counts.iterrows():
+        fig.add_trace(
+            go.Bar(
+                x=centers,
+                y=row.to_numpy(),
+                width=edges[1:] - edges[:-1],
+                name=category,
+                marker_color=category_color(category),
+            )
+        )
+    fig.update_layout(
+        barmode="relative",
+        bargap=0,
+        title=title,
+        xaxis_title=column,
+        yaxis_title="count",
+        legend_title_text="Category",
+    )
+    return fig
@@ -0,0 +1,91 @@
+import argparse
+import sys
+
+from rfm_engine import (
+    DEFAULT_THRESHOLDS,
+    SEGMENTS,
+    Thresholds,
+    auto_thresholds,
+    compute_rfm,
+    load_segments,
+    score,
+)
+from rfm_io import CHUNKSIZE, load_transactions, stream_rfm, write_scores
+
+# Headless batch scoring: reads transactions, computes RFM and writes
+# id -> Category, R_rank, F_rank, M_rank. Imports neither Streamlit nor Plotly.
+#
+#   python rfm_cli.py in/tables/rfm_data.csv out/tables/rfm_segments.csv --thresholds auto
+
+
+# Function to parse a comma-separated list of four threshold values
+def threshold_list(text):
+    values = tuple(float(v) for v in text.split(","))
+    if len(values) != 4:
+        raise argparse.ArgumentTypeError("expected four comma-separated values")
+    return values
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Score customers into RFM segments.")
+    parser.add_argument("input", nargs="?", default="in/tables/rfm_data.csv")
+    parser.add_argument("output", nargs="?", default="out/tables/rfm_segments.csv")
+    parser.add_argument("--start-date", help="first transaction date to include")
+    parser.add_argument("--end-date", help="last transaction date to include")
+    parser.add_argument(
+        "--thresholds",
+        choices=["default", "auto"],
+        default="default",
+        help="built-in thresholds or quintiles of the current window",
+    )
+    parser.add_argument("--recency", type=threshold_list, help="R5,R4,R3,R2")
+    parser.add_argument("--frequency", type=threshold_list, help="F5,F4,F3,F2")
+    parser.add_argument("--monetary", type=threshold_list, help="M5,M4,M3,M2")
+    parser.add_argument("--segments", help="JSON file with a custom segment map")
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="aggregate the input in chunks instead of loading it whole",
+    )
+    parser.add_argument("--chunksize", type=int, default=CHUNKSIZE)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="aggregation processes (0 = all cores); not available with --stream",
+    )
+    args = parser.parse_args(argv)
+    if args.stream and args.workers != 1:
+        parser.error("--workers can't be combined with --stream")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.stream:
+        rfm_df = stream_rfm(args.input, args.start_date, args.end_date, args.chunksize)
+    else:
+        rfm_df = compute_rfm(
+            load_transactions(args.input),
+            args.start_date,
+            args.end_date,
+            workers=args.workers or None,
+        )
+
+    thresholds = auto_thresholds(rfm_df) if args.thresholds == "auto" else DEFAULT_THRESHOLDS
+    thresholds = Thresholds(
+        args.recency or thresholds.recency,
+        args.frequency or thresholds.frequency,
+        args.monetary or thresholds.monetary,
+    )
+    segments = load_segments(args.segments) if args.segments else SEGMENTS
+
+    scores = score(rfm_df, thresholds, segments)
+    write_scores(scores, args.output, args.chunksize)
+    print(f"Wrote {len(scores)} customers to {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
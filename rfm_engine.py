@@ -0,0 +1,963 @@
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+# RFM engine shared by rfm.py, rfmkeboola.py and headless jobs.
+# Nothing in this module imports Streamlit or Plotly.
+
+
+# Segment definitions: regex over the two-digit R/F score -> Category.
+# The first matching pattern wins; custom maps in the same format can be
+# passed to score() or loaded from JSON with load_segments().
+SEGMENTS = {
+    "5[4-5]": "01. Champions",
+    "[3-4][4-5]": "02. Loyal Customers",
+    "[4-5][2-3]": "03. Potential Loyalists",
+    "51": "04. Recent Customers",
+    "41": "05. Promising",
+    "33": "06. Need Attention",
+    "3[1-2]": "07. About to Sleep",
+    "[1-2][5]": "08. Can't Lose",
+    "[1-2][3-4]": "09. At Risk",
+    "2[1-2]": "10. Hibernating",
+    "1[1-2]": "11. Lost",
+}
+
+UNCATEGORIZED = "Uncategorized"
+
+# Define category_order
+category_order = list(dict.fromkeys(SEGMENTS.values()))
+
+
+# Threshold lists for the R5..R2, F5..F2 and M5..M2 boundaries
+class Thresholds(NamedTuple):
+    recency: tuple
+    frequency: tuple
+    monetary: tuple
+
+
+DEFAULT_THRESHOLDS = Thresholds(
+    recency=(3, 10, 25, 66),
+    frequency=(13.6, 24.5, 38.8, 66.6),
+    monetary=(6841, 3079, 1573, 672),
+)
+
+# Quantiles used for automatic R/F/M boundaries (quintiles)
+QUINTILES = (0.2, 0.4, 0.6, 0.8)
+
+# Up to this many customers auto thresholds use exact quantiles, above it a sketch
+EXACT_QUANTILE_LIMIT = 1_000_000
+
+# Maximum number of customers sent to a scatter plot; 0 disables sampling
+SCATTER_POINT_BUDGET = int(os.environ.get("RFM_SCATTER_POINT_BUDGET", 5000))
+
+
+# Frequency keys of the tuning cube: two significant digits (0.1 day steps
+# below 10 days, 1 day below 100, 10 days below 1,000 and so on up to 100,000
+# days) plus the default boundaries. A cube therefore has a bounded number of
+# Frequency keys however many customers it summarises.
+FREQUENCY_GRID = np.unique(
+    np.round(
+        np.concatenate(
+            [np.arange(0, 10, 0.1)]
+            + [np.arange(10**d, 10 ** (d + 1), 10 ** (d - 1)) for d in range(1, 5)]
+            + [[100_000], DEFAULT_THRESHOLDS.frequency]
+        ),
+        1,
+    )
+)
+
+_DAY_NS = np.int64(24 * 60 * 60 * 10**9)
+
+# Compact dtypes of the RFM table; Monetary stays float64 because it holds
+# revenue totals that are summed again per segment
+RFM_DTYPES = {
+    "Recency": "int32",
+    "Frequency": "float32",
+    "AOS": "float32",
+}
+
+
+# Function to store dates as int32 days since the epoch (4 bytes a row instead
+# of 8). Dates with a time of day are returned unchanged, since days can't
+# represent them; every engine function accepts both forms of 'date'.
+def compact_dates(dates):
+    values = dates.to_numpy(dtype="datetime64[ns]")
+    if np.isnat(values).any():
+        return dates
+    days, remainder = np.divmod(values.view("int64"), _DAY_NS)
+    if remainder.any() or len(days) and not (
+        np.iinfo("int32").min <= days.min() and days.max() <= np.iinfo("int32").max
+    ):
+        return dates
+    return pd.Series(days.astype("int32"), index=dates.index, name=dates.name)
+
+
+# Function to tell whether a 'date' column holds compact day numbers
+def _compact(dates):
+    return pd.api.types.is_integer_dtype(dates.dtype)
+
+
+# Function to get the first and last transaction date as Timestamps
+def date_span(transactions):
+    timestamps = date_timestamps(transactions)
+    return pd.Timestamp(timestamps.min()), pd.Timestamp(timestamps.max())
+
+
+# Function to filter transactions to the [start_date, end_date] window
+def filter_transactions(df, start_date=None, end_date=None):
+    mask = pd.Series(True, index=df.index)
+    if start_date is not None:
+        start = pd.to_datetime(start_date)
+        if _compact(df["date"]):
+            # First whole day on or after start
+            start = -(-start.value // _DAY_NS)
+        mask &= df["date"] >= start
+    if end_date is not None:
+        end = pd.to_datetime(end_date)
+        if _compact(df["date"]):
+            end = end.value // _DAY_NS
+        mask &= df["date"] <= end
+    return df[mask]
+
+
+# Reducers that combine per-id aggregates computed over separate row sets
+AGGREGATE_REDUCERS = {
+    "first": "min",
+    "last": "max",
+    "count": "sum",
+    "Monetary": "sum",
+    "num_of_events": "sum",
+}
+
+
+# Function to get the 'date' column as int64 nanoseconds
+def date_timestamps(transactions):
+    dates = transactions["date"]
+    if _compact(dates):
+        return dates.to_numpy(dtype="int64") * _DAY_NS
+    return dates.to_numpy(dtype="datetime64[ns]").view("int64")
+
+
+# Function to aggregate transactions per id in a single pass with built-in reducers
+def aggregate_transactions(transactions):
+    columns = {
+        "id": transactions["id"],
+        "date": date_timestamps(transactions),
+        # Accumulate in float64 even when value is stored as float32
+        "value": transactions["value"].astype("float64"),
+    }
+    aggregations = {
+        "first": ("date", "min"),
+        "last": ("date", "max"),
+        "count": ("date", "size"),
+        "Monetary": ("value", "sum"),  # Monetary: total value of purchases
+    }
+    if "num_of_events" in transactions.columns:
+        columns["num_of_events"] = transactions["num_of_events"].astype("int64")
+        aggregations["num_of_events"] = ("num_of_events", "sum")
+
+    return pd.DataFrame(columns).groupby("id", observed=True).agg(**aggregations)
+
+
+# Function to merge per-id aggregates of disjoint transaction sets
+def merge_aggregates(*aggregates):
+    combined = pd.concat(aggregates)
+    reducers = {column: AGGREGATE_REDUCERS[column] for column in combined.columns}
+    return combined.groupby(level=0, observed=True).agg(reducers)
+
+
+# Function to aggregate transactions on a process pool.
+# Rows are hash-partitioned by id, so every customer lands in exactly one
+# shard, keeps its row order and gets the same sums as the serial path.
+def aggregate_transactions_parallel(transactions, workers=None):
+    workers = workers or os.cpu_count() or 1
+    shard = pd.util.hash_pandas_object(transactions["id"], index=False).to_numpy() % workers
+    shards = [transactions[shard == i] for i in range(workers)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        aggregated = list(executor.map(aggregate_transactions, shards))
+    return pd.concat(aggregated).sort_index()
+
+
+# Function to calculate Recency, Frequency, Monetary and AOS per customer.
+# With workers > 1 the aggregation runs on that many processes.
+def compute_rfm(transactions, start_date=None, end_date=None, workers=1):
+    filtered_df = filter_transactions(transactions, start_date, end_date)
+    if workers == 1:
+        aggregated = aggregate_transactions(filtered_df)
+    else:
+        aggregated = aggregate_transactions_parallel(filtered_df, workers)
+    return derive_rfm(aggregated, date_timestamps(filtered_df).max(initial=0))
+
+
+# Function to derive Recency, Frequency and AOS from per-id aggregates
+# (first/last purchase timestamps in ns, purchase count and Monetary)
+def derive_rfm(aggregated, max_timestamp):
+    first = aggregated["first"].to_numpy()
+    last = aggregated["last"].to_numpy()
+    count = aggregated["count"].to_numpy()
+
+    rfm_df = pd.DataFrame({"id": aggregated.index.array})
+
+    # Recency: days since last purchase, counted from the day after the last date
+    rfm_df["Recency"] = (max_timestamp + _DAY_NS - last) // _DAY_NS
+    rfm_df["Monetary"] = aggregated["Monetary"].to_numpy()
+
+    # Frequency: days between the first and last purchase / number of purchases,
+    # at least 1
+    rfm_df["Frequency"] = np.maximum(((last - first) // _DAY_NS) / count, 1)
+
+    # Calculate Average Order Size (AOS)
+    rfm_df["AOS"] = rfm_df["Monetary"] / rfm_df["Frequency"]
+    return rfm_df.astype(RFM_DTYPES)
+
+
+# Index of per-customer cumulative aggregates for fast date-window queries.
+# Transactions are grouped once by (id, date) and sorted, so the aggregates
+# for any [start_date, end_date] window come from two binary searches per
+# customer and a difference of prefix sums, without rescanning transactions.
+class WindowIndex:
+    def __init__(self, transactions):
+        timestamps = date_timestamps(transactions)
+        # Distinct purchase timestamps, including rows without an id
+        self.timestamps = np.unique(timestamps)
+
+        columns = {
+            "id": transactions["id"],
+            "date": timestamps,
+            "value": transactions["value"].astype("float64"),
+        }
+        aggregations = {"count": ("value", "size"), "Monetary": ("value", "sum")}
+        if "num_of_events" in transactions.columns:
+            columns["num_of_events"] = transactions["num_of_events"].astype("int64")
+            aggregations["num_of_events"] = ("num_of_events", "sum")
+        daily = (
+            pd.DataFrame(columns)
+            .groupby(["id", "date"], sort=True, observed=True)
+            .agg(**aggregations)
+        )
+
+        codes, self.ids = pd.factorize(daily.index.get_level_values("id"), sort=True)
+        self.dates = daily.index.get_level_values("date").to_numpy()
+        # Composite (customer, date rank) key, ascending because daily is sorted
+        self.keys = codes * len(self.timestamps) + np.searchsorted(
+            self.timestamps, self.dates
+        )
+        self.codes = np.arange(len(self.ids), dtype="int64")
+
+        # Prefix sums: global for integer counters, per customer for Monetary
+        # so the differences stay small and precise
+        self.cumulative = {}
+        for column in daily.columns:
+            values = daily[column].to_numpy()
+            if column == "Monetary":
+                inclusive = (
+                    daily[column].groupby(level="id", observed=True).cumsum().to_numpy()
+                )
+            else:
+                inclusive = np.cumsum(values)
+            self.cumulative[column] = (inclusive - values, inclusive)
+
+    # Function to aggregate the [start_date, end_date] window per id.
+    # Returns (aggregated, max_timestamp) like the streaming path.
+    def aggregate(self, start_date=None, end_date=None):
+        start_rank = 0
+        end_rank = len(self.timestamps)
+        if start_date is not None:
+            start = pd.to_datetime(start_date).to_datetime64().astype("datetime64[ns]")
+            start_rank = np.searchsorted(self.timestamps, start.view("int64"), "left")
+        if end_date is not None:
+            end = pd.to_datetime(end_date).to_datetime64().astype("datetime64[ns]")
+            end_rank = np.searchsorted(self.timestamps, end.view("int64"), "right")
+
+        base = self.codes * len(self.timestamps)
+        lo = np.searchsorted(self.keys, base + start_rank, "left")
+        hi = np.searchsorted(self.keys, base + end_rank, "left")
+        present = hi > lo
+        lo, hi = lo[present], hi[present]
+
+        aggregated = pd.DataFrame(
+            {"first": self.dates[lo], "last": self.dates[hi - 1]},
+            index=pd.Index(self.ids[present], name="id"),
+        )
+        for column, (exclusive, inclusive) in self.cumulative.items():
+            aggregated[column] = inclusive[hi - 1] - exclusive[lo]
+
+        max_timestamp = self.timestamps[end_rank - 1] if end_rank > start_rank else 0
+        return aggregated, max_timestamp
+
+    # Function to calculate the RFM table for the [start_date, end_date] window
+    def rfm(self, start_date=None, end_date=None):
+        return derive_rfm(*self.aggregate(start_date, end_date))
+
+
+# Mergeable quantile sketch with relative error (DDSketch style).
+# Values are counted in logarithmic buckets, so a sketch has a bounded size,
+# is built in one vectorized pass and two sketches merge by adding counts.
+class QuantileSketch:
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.positive = pd.Series(dtype="int64")
+        self.negative = pd.Series(dtype="int64")
+        self.zeros = 0
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def _bucket_counts(self, magnitudes):
+        buckets = np.ceil(np.log(magnitudes) / self.log_gamma).astype("int64")
+        return pd.Series(buckets).value_counts()
+
+    # Function to add an array of values to the sketch
+    def update(self, values):
+        values = np.asarray(values, dtype="float64")
+        values = values[~np.isnan(values)]
+        self.count += len(values)
+        self.zeros += int((values == 0).sum())
+        self.min = min(self.min, values.min(initial=np.inf))
+        self.max = max(self.max, values.max(initial=-np.inf))
+        self.positive = self.positive.add(
+            self._bucket_counts(values[values > 0]), fill_value=0
+        ).astype("int64")
+        self.negative = self.negative.add(
+            self._bucket_counts(-values[values < 0]), fill_value=0
+        ).astype("int64")
+        return self
+
+    # Function to fold another sketch with the same accuracy into this one
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        self.count += other.count
+        self.zeros += other.zeros
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.positive = self.positive.add(other.positive, fill_value=0).astype("int64")
+        self.negative = self.negative.add(other.negative, fill_value=0).astype("int64")
+        return self
+
+    # Function to estimate quantiles (same rank convention as np.quantile's 'lower')
+    def quantile(self, quantiles):
+        negative = self.negative.sort_index(ascending=False)
+        positive = self.positive.sort_index()
+        values = np.concatenate(
+            [
+                -2 * self.gamma ** negative.index.to_numpy(dtype="float64") / (self.gamma + 1),
+                [0.0],
+                2 * self.gamma ** positive.index.to_numpy(dtype="float64") / (self.gamma + 1),
+            ]
+        )
+        counts = np.concatenate([negative.to_numpy(), [self.zeros], positive.to_numpy()])
+        cumulative = np.cumsum(counts)
+
+        ranks = np.floor(np.asarray(quantiles, dtype="float64") * (self.count - 1))
+        estimates = values[np.searchsorted(cumulative, ranks, side="right")]
+        # Exact extremes keep boundaries on tied minimum/maximum values exact
+        return np.clip(estimates, self.min, self.max)
+
+
+# Function to build Recency, Frequency and AOS sketches for an RFM table
+def sketch_rfm(rfm_df, relative_accuracy=0.01):
+    return {
+        column: QuantileSketch(relative_accuracy).update(rfm_df[column])
+        for column in ("Recency", "Frequency", "AOS")
+    }
+
+
+# Function to turn a quantile function into quintile thresholds in score() order.
+# Recency is integer days, so its boundaries are floored without changing ranks.
+def _quintile_thresholds(quantile):
+    recency = np.floor(quantile("Recency", QUINTILES))
+    monetary = np.round(quantile("AOS", QUINTILES[::-1]), 2)
+    return Thresholds(
+        tuple(int(t) for t in recency),
+        snap_frequency(quantile("Frequency", QUINTILES)),
+        tuple(float(t) for t in monetary),
+    )
+
+
+# Function to derive thresholds from merged sketches (streamed or sharded data)
+def thresholds_from_sketches(sketches):
+    return _quintile_thresholds(lambda column, q: sketches[column].quantile(q))
+
+
+# Function to derive quintile R/F/M thresholds from the current RFM table.
+# Exact quantiles are used up to exact_limit customers, a sketch above it.
+def auto_thresholds(rfm_df, exact_limit=EXACT_QUANTILE_LIMIT):
+    if len(rfm_df) == 0:
+        return DEFAULT_THRESHOLDS
+    if len(rfm_df) > exact_limit:
+        return thresholds_from_sketches(sketch_rfm(rfm_df))
+    return _quintile_thresholds(
+        lambda column, q: np.nanquantile(rfm_df[column].to_numpy(dtype="float64"), q)
+    )
+
+
+# Function to load a custom segment map from a JSON object {pattern: category}
+def load_segments(json_path):
+    with open(json_path, encoding="utf-8") as f:
+        return dict(json.load(f))
+
+
+# Function to compile a segment map into a 5x5 lookup table once.
+# Returns (table, categories) where table[r - 1, f - 1] is the category code.
+@lru_cache(maxsize=32)
+def _segment_table(segment_items):
+    categories = list(dict.fromkeys(category for _, category in segment_items))
+    table = np.full((5, 5), -1, dtype="int8")
+    for r in range(1, 6):
+        for f in range(1, 6):
+            for pattern, category in segment_items:
+                if re.match(pattern, f"{r}{f}"):
+                    table[r - 1, f - 1] = categories.index(category)
+                    break
+    if (table < 0).any():
+        table[table < 0] = len(categories)
+        categories.append(UNCATEGORIZED)
+    return table, tuple(categories)
+
+
+# Function to assign categories to whole rank columns with one table lookup
+def assign_categories(r_rank, f_rank, segments=SEGMENTS):
+    table, categories = _segment_table(tuple(segments.items()))
+    r = np.asarray(r_rank, dtype="intp") - 1
+    f = np.asarray(f_rank, dtype="intp") - 1
+    return pd.Categorical.from_codes(table[r, f], categories=categories, ordered=True)
+
+
+# Function to assign a category to a single R and F score
+def assign_category(r, f, segments=SEGMENTS):
+    table, categories = _segment_table(tuple(segments.items()))
+    return categories[table[int(r) - 1, int(f) - 1]]
+
+
+# Function to map values to ranks 5..1 in one vectorized pass.
+# The rank is 5 for the first threshold matched, 4 for the second and so on
+# down to 1, and 1 when none matches, whatever the number of thresholds. A value matches a threshold when value <= t
+# (upper=True, used for Recency and Frequency) or value >= t (upper=False,
+# used for Monetary).
+def _rank(values, thresholds, upper):
+    values = np.asarray(values)
+    if values.dtype != np.float32:
+        values = values.astype("float64")
+    # Compare in the precision the values are stored in, so a value equal to a
+    # threshold stays equal after rounding to float32
+    t = np.asarray(thresholds, dtype="float64").astype(values.dtype)
+    n = len(t)
+
+    if upper and np.all(np.diff(t) >= 0):
+        # Index of the first threshold with value <= t
+        first = np.searchsorted(t, values, side="left")
+    elif not upper and np.all(np.diff(t) <= 0):
+        # Thresholds descend, so count how many of them are <= value
+        first = n - np.searchsorted(t[::-1], values, side="right")
+    else:
+        # Unsorted thresholds: keep the first-match semantics
+        hits = values[:, None] <= t if upper else values[:, None] >= t
+        first = np.where(hits.any(axis=1), hits.argmax(axis=1), n)
+
+    ranks = np.where(first < n, np.maximum(5 - first, 1), 1)
+    # Missing values never match a threshold
+    ranks[np.isnan(values)] = 1
+    return ranks.astype("uint8")
+
+
+# Function to assign R/F/M ranks and the two-digit RFM_Score to an RFM table
+def assign_ranks(rfm_df, thresholds=DEFAULT_THRESHOLDS):
+    recency_thresholds, frequency_thresholds, monetary_thresholds = thresholds
+    rfm_df = rfm_df.copy()
+
+    rfm_df["R_rank"] = _rank(rfm_df["Recency"], recency_thresholds, upper=True)
+    rfm_df["F_rank"] = _rank(rfm_df["Frequency"], frequency_thresholds, upper=True)
+    rfm_df["M_rank"] = _rank(rfm_df["AOS"], monetary_thresholds, upper=False)
+
+    # Two-digit R/F score, e.g. 5 and 4 -> 54
+    rfm_df["RFM_Score"] = rfm_df["R_rank"] * np.uint8(10) + rfm_df["F_rank"]
+    return rfm_df
+
+
+# Function to assign R/F/M ranks and the segment Category to an RFM table
+def score(rfm_df, thresholds=DEFAULT_THRESHOLDS, segments=SEGMENTS):
+    rfm_df = assign_ranks(rfm_df, thresholds)
+    rfm_df["Category"] = assign_categories(
+        rfm_df["R_rank"], rfm_df["F_rank"], segments
+    )
+    return rfm_df
+
+
+# Function to recalculate RFM values based on parameters
+def recalculate_rfm(rfm_df, recency_thresholds, frequency_thresholds, monetary_thresholds):
+    return score(
+        rfm_df,
+        Thresholds(
+            tuple(recency_thresholds),
+            tuple(frequency_thresholds),
+            tuple(monetary_thresholds),
+        ),
+    )
+
+
+# Function to round Frequency thresholds to the nearest FREQUENCY_GRID points
+def snap_frequency(thresholds):
+    values = np.asarray(thresholds, dtype="float64")
+    upper = np.clip(np.searchsorted(FREQUENCY_GRID, values), 1, len(FREQUENCY_GRID) - 1)
+    lower = upper - 1
+    nearest = np.where(
+        values - FREQUENCY_GRID[lower] <= FREQUENCY_GRID[upper] - values, lower, upper
+    )
+    return tuple(float(t) for t in FREQUENCY_GRID[nearest])
+
+
+# Function to snap the Frequency thresholds of a set to the cube grid
+def snap_thresholds(thresholds):
+    return thresholds._replace(frequency=snap_frequency(thresholds.frequency))
+
+
+# Function to key Frequency values on the grid point closing their cell: a
+# value v belongs to the cell (g[k-1], g[k]] keyed g[k], values above the grid
+# (and NaN) to a cell keyed inf. Values are compared in the precision _rank()
+# uses, so v <= g[j] exactly when its key is <= g[j].
+def _frequency_keys(values):
+    values = np.asarray(values)
+    if values.dtype != np.float32:
+        values = values.astype("float64")
+    cells = np.searchsorted(FREQUENCY_GRID.astype(values.dtype), values, side="left")
+    return np.append(FREQUENCY_GRID, np.inf)[cells]
+
+
+# Function to collapse an RFM table into (Recency, Frequency) cells holding the
+# customer count and the Monetary and AOS sums of each cell.
+# Recency is keyed on its integer days and Frequency on FREQUENCY_GRID, so the
+# cube size is bounded by the date span, not the number of customers. Any
+# threshold set with Frequency thresholds on the grid (see snap_thresholds())
+# ranks every cell exactly as it would rank its customers. Categories depend
+# on the R and F ranks only, so a threshold set is evaluated on the cells.
+def rfm_cube(rfm_df):
+    cells = pd.DataFrame(
+        {
+            "Recency": rfm_df["Recency"].to_numpy(),
+            "Frequency": _frequency_keys(rfm_df["Frequency"]),
+            "Monetary": rfm_df["Monetary"].to_numpy(dtype="float64"),
+            "AOS": rfm_df["AOS"].to_numpy(dtype="float64"),
+        }
+    )
+    return (
+        cells.groupby(["Recency", "Frequency"], sort=False)
+        .agg(
+            Customers=("Monetary", "size"),
+            Monetary=("Monetary", "sum"),
+            AOS=("AOS", "sum"),
+        )
+        .reset_index()
+    )
+
+
+# Function to assign R/F ranks and the segment Category to every cube cell
+def score_cube(cube, thresholds=DEFAULT_THRESHOLDS, segments=SEGMENTS):
+    recency_thresholds, frequency_thresholds, _ = thresholds
+    cube = cube.copy()
+    cube["R_rank"] = _rank(cube["Recency"], recency_thresholds, upper=True)
+    cube["F_rank"] = _rank(cube["Frequency"], frequency_thresholds, upper=True)
+    cube["Category"] = assign_categories(cube["R_rank"], cube["F_rank"], segments)
+    return cube
+
+
+# Function to total customers and revenue per category of a scored cube.
+# Always returns one row per category in category_order.
+def cube_category_totals(scored_cube):
+    totals = (
+        scored_cube.groupby("Category", observed=False)[["Customers", "Monetary"]]
+        .sum()
+        .reindex(category_order, fill_value=0)
+    )
+    return totals.rename_axis("Category").reset_index()
+
+
+# Function to average AOS per (R_rank, F_rank) of a scored cube
+def cube_rank_means(scored_cube, column="AOS"):
+    sums = scored_cube.pivot_table(
+        index="R_rank", columns="F_rank", values=[column, "Customers"], aggfunc="sum"
+    )
+    return (sums[column] / sums["Customers"]).fillna(0)
+
+
+# Quantiles of the cube values offered to the threshold optimizer
+SEARCH_QUANTILES = tuple(np.round(np.arange(0.05, 1.0, 0.05), 2))
+
+# Threshold sets scored per batch by the optimizer
+SEARCH_BATCH_SIZE = 5000
+
+
+# Objectives of optimize_thresholds(): loss per candidate from its customer
+# counts and revenue per category (arrays of shape candidates x categories).
+# "balanced" prefers equal segment sizes, "champions_revenue" a target share
+# of revenue in the first segment (Champions in the default map).
+def _balanced_loss(counts, revenue, target):
+    shares = counts / counts.sum(axis=1, keepdims=True)
+    return ((shares - 1 / counts.shape[1]) ** 2).sum(axis=1)
+
+
+def _champions_revenue_loss(counts, revenue, target):
+    shares = revenue[:, 0] / revenue.sum(axis=1)
+    return np.abs(shares - target) + 1e-3 * _balanced_loss(counts, revenue, target)
+
+
+OBJECTIVES = {
+    "balanced": _balanced_loss,
+    "champions_revenue": _champions_revenue_loss,
+}
+
+
+# Function to pick candidate thresholds: customer-weighted quantiles of the
+# finite cube values, deduplicated. Candidates are actual cell keys, so every
+# candidate is evaluated exactly.
+def _threshold_candidates(values, weights, quantiles=SEARCH_QUANTILES):
+    finite = np.isfinite(values)
+    values, weights = values[finite], weights[finite]
+    order = np.argsort(values)
+    values = values[order]
+    cumulative = np.cumsum(weights[order])
+    positions = np.searchsorted(cumulative, np.asarray(quantiles) * cumulative[-1])
+    return np.unique(values[np.minimum(positions, len(values) - 1)])
+
+
+# Function to rank bins for many threshold sets at once.
+# thresholds has shape (sets, 4) with ascending rows; a bin represented by
+# value v gets 5 minus the number of thresholds below v, as in _rank().
+def _rank_sets(thresholds, representatives):
+    below = thresholds[:, :, None] < representatives[None, None, :]
+    return 5 - below.sum(axis=1)
+
+
+# Function to total customers and revenue per category for a batch of
+# threshold sets over the binned (Recency, Frequency) grid
+def _evaluate_sets(args):
+    grid_counts, grid_revenue, recency_bins, frequency_bins, recency_sets, frequency_sets, table = args
+    size = int(table.max()) + 1
+    r = _rank_sets(recency_sets, recency_bins) - 1
+    f = _rank_sets(frequency_sets, frequency_bins) - 1
+    codes = table[r[:, :, None], f[:, None, :]].reshape(len(r), -1).astype("int64")
+    flat = (np.arange(len(r))[:, None] * size + codes).ravel()
+    counts = np.bincount(flat, np.tile(grid_counts.ravel(), len(r)), len(r) * size)
+    revenue = np.bincount(flat, np.tile(grid_revenue.ravel(), len(r)), len(r) * size)
+    return counts.reshape(len(r), size), revenue.reshape(len(r), size)
+
+
+# Function to draw n sorted rows of 4 distinct indices into size candidates.
+# With fewer than 4 candidates the indices repeat, the only way to fill a set.
+def _pick_distinct(rng, size, n):
+    if size < 4:
+        return np.sort(rng.integers(0, size, (n, 4)), axis=1)
+    return np.sort(np.argsort(rng.random((n, size)), axis=1)[:, :4], axis=1)
+
+
+# Function to search R and F thresholds that minimise an objective over a
+# tuning cube. Candidates are drawn from quantiles of the cube values, the
+# cube is binned on them and every threshold set is scored on those bins in
+# vectorized batches (on a process pool when workers > 1).
+# Monetary thresholds don't affect categories and are passed through.
+# Returns (thresholds, loss).
+def optimize_thresholds(
+    cube,
+    objective="balanced",
+    target=0.5,
+    n_candidates=20000,
+    seed=0,
+    workers=1,
+    monetary=DEFAULT_THRESHOLDS.monetary,
+    segments=SEGMENTS,
+):
+    loss_function = OBJECTIVES[objective]
+    table, _ = _segment_table(tuple(segments.items()))
+    weights = cube["Customers"].to_numpy(dtype="float64")
+    recency = cube["Recency"].to_numpy(dtype="float64")
+    frequency = cube["Frequency"].to_numpy(dtype="float64")
+    recency_candidates = _threshold_candidates(recency, weights)
+    frequency_candidates = _threshold_candidates(frequency, weights)
+
+    # Bin the cube on the candidates: bin b holds values in (c[b-1], c[b]],
+    # so the candidate itself represents it and the last bin is open-ended
+    recency_index = np.searchsorted(recency_candidates, recency, "left")
+    frequency_index = np.searchsorted(frequency_candidates, frequency, "left")
+    shape = (len(recency_candidates) + 1, len(frequency_candidates) + 1)
+    flat = recency_index * shape[1] + frequency_index
+    grid_counts = np.bincount(flat, weights, shape[0] * shape[1]).reshape(shape)
+    grid_revenue = np.bincount(
+        flat, cube["Monetary"].to_numpy(dtype="float64"), shape[0] * shape[1]
+    ).reshape(shape)
+    recency_bins = np.append(recency_candidates, np.inf)
+    frequency_bins = np.append(frequency_candidates, np.inf)
+
+    # Random ascending threshold sets of distinct candidates; repeated sets
+    # are evaluated once
+    rng = np.random.default_rng(seed)
+    recency_picks = _pick_distinct(rng, len(recency_candidates), n_candidates)
+    frequency_picks = _pick_distinct(rng, len(frequency_candidates), n_candidates)
+    picks = np.unique(np.hstack([recency_picks, frequency_picks]), axis=0)
+    recency_sets = recency_candidates[picks[:, :4]]
+    frequency_sets = frequency_candidates[picks[:, 4:]]
+    n_candidates = len(picks)
+
+    batches = [
+        (
+            grid_counts,
+            grid_revenue,
+            recency_bins,
+            frequency_bins,
+            recency_sets[i : i + SEARCH_BATCH_SIZE],
+            frequency_sets[i : i + SEARCH_BATCH_SIZE],
+            table,
+        )
+        for i in range(0, n_candidates, SEARCH_BATCH_SIZE)
+    ]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_evaluate_sets, batches))
+    else:
+        results = [_evaluate_sets(batch) for batch in batches]
+
+    losses = np.concatenate(
+        [loss_function(counts, revenue, target) for counts, revenue in results]
+    )
+    best = int(np.nanargmin(losses))
+    # Frequency candidates are grid points, so the set is already snapped
+    thresholds = Thresholds(
+        tuple(int(t) for t in recency_sets[best]),
+        tuple(float(t) for t in frequency_sets[best]),
+        tuple(monetary),
+    )
+    return thresholds, float(losses[best])
+
+
+# Function to take a sample of at most ~max_points rows stratified on strata
+# (a Series aligned with rfm_df). Each stratum keeps a share of the budget
+# proportional to its size, and at least one row.
+def _stratified_sample(rfm_df, strata, max_points, seed):
+    if not max_points or len(rfm_df) <= max_points:
+        return rfm_df
+
+    sizes = strata.value_counts()
+    quotas = np.maximum(np.round(sizes * max_points / len(rfm_df)), 1)
+
+    # Shuffle once, then keep the first quota rows of each stratum
+    shuffled = strata.sample(frac=1, random_state=seed)
+    position = shuffled.groupby(shuffled, observed=True).cumcount()
+    quota = shuffled.map(quotas).astype("int64")
+    return rfm_df.loc[shuffled[position < quota].index].sort_index()
+
+
+# Function to take a stratified sample of at most ~max_points customers.
+# Each Category keeps a share of the budget proportional to its size, and
+# at least one point, so small segments stay visible in scatter plots.
+def sample_by_category(rfm_df, max_points=SCATTER_POINT_BUDGET, seed=0):
+    return _stratified_sample(rfm_df, rfm_df["Category"], max_points, seed)
+
+
+# Function to take a sample stratified on the tuning cube cells: at least one
+# customer per (Recency, Frequency) cell, plus a share of max_points
+# proportional to cell size. Every cell falls into one category for any
+# threshold set on the grid, so the sample can be scored with any such set and
+# still show every non-empty category. It has at most max_points + cells rows.
+def sample_by_cell(rfm_df, max_points=SCATTER_POINT_BUDGET, seed=0):
+    cells = pd.Series(
+        pd.MultiIndex.from_arrays(
+            [rfm_df["Recency"].to_numpy(), _frequency_keys(rfm_df["Frequency"])]
+        ).factorize()[0],
+        index=rfm_df.index,
+    )
+    return _stratified_sample(rfm_df, cells, max_points, seed)
+
+
+# Function to compute per-Category box plot statistics for one column:
+# quartiles, mean and Tukey whiskers (furthest values within 1.5 IQR)
+def box_stats(rfm_df, column):
+    grouped = rfm_df.groupby("Category", observed=True)[column]
+    stats = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    stats.columns = ["q1", "median", "q3"]
+    stats["mean"] = grouped.mean()
+    stats["count"] = grouped.size()
+
+    iqr = stats["q3"] - stats["q1"]
+    low = rfm_df["Category"].map(stats["q1"] - 1.5 * iqr).astype("float64")
+    high = rfm_df["Category"].map(stats["q3"] + 1.5 * iqr).astype("float64")
+    inside = rfm_df[column].between(low, high)
+    whiskers = rfm_df[inside].groupby("Category", observed=True)[column]
+    stats["lowerfence"] = whiskers.min()
+    stats["upperfence"] = whiskers.max()
+    return stats.reset_index()
+
+
+# Function to count values per (Category, bin) over shared bin edges.
+# Returns (edges, counts) where counts has one row per category.
+def histogram_counts(rfm_df, column, bins=50):
+    values = rfm_df[column].to_numpy(dtype="float64")
+    edges = np.histogram_bin_edges(values[~np.isnan(values)], bins=bins)
+    bin_index = np.clip(np.searchsorted(edges, values, side="right") - 1, 0, bins - 1)
+
+    codes = rfm_df["Category"].cat.codes.to_numpy().astype("int64")
+    categories = rfm_df["Category"].cat.categories
+    valid = (codes >= 0) & ~np.isnan(values)
+    counts = np.bincount(
+        codes[valid] * bins + bin_index[valid], minlength=len(categories) * bins
+    ).reshape(len(categories), bins)
+
+    counts = pd.DataFrame(counts, index=pd.Index(categories, name="Category"))
+    return edges, counts[counts.sum(axis=1) > 0]
+
+
+# Function to profile every segment in one groupby pass: customer count,
+# revenue share, median Recency/Frequency/Monetary and mean AOS.
+# Always returns one row per category in category_order.
+def segment_profile(rfm_df):
+    profile = (
+        rfm_df.groupby("Category", observed=True)
+        .agg(
+            Customers=("Recency", "size"),
+            Revenue=("Monetary", "sum"),
+            Median_Recency=("Recency", "median"),
+            Median_Frequency=("Frequency", "median"),
+            Median_Monetary=("Monetary", "median"),
+            Mean_AOS=("AOS", "mean"),
+        )
+        .reindex(category_order)
+    )
+    profile["Customers"] = profile["Customers"].fillna(0).astype("int64")
+    profile["Revenue"] = profile["Revenue"].fillna(0)
+    total_revenue = profile["Revenue"].sum()
+    profile.insert(
+        2,
+        "Revenue_Share_Pct",
+        100 * profile["Revenue"] / total_revenue if total_revenue else 0.0,
+    )
+    return profile.rename_axis("Category").reset_index()
+
+
+# Function to sum transaction revenue per (month, Category) without merging
+# the scores onto the transactions: ids are looked up in the scored table and
+# revenue is bincounted over (month, category code).
+# Returns (total, by_category), both indexed by month end; total also counts
+# transactions whose id is not scored (e.g. missing ids) and by_category has
+# one column per category in category_order.
+def monthly_revenue_by_category(transactions, rfm_df):
+    months = (
+        date_timestamps(transactions).view("datetime64[ns]").astype("datetime64[M]").view("int64")
+    )
+    values = np.nan_to_num(transactions["value"].to_numpy(dtype="float64"))
+    if len(months) == 0:
+        empty = pd.DatetimeIndex([], name="date")
+        return pd.Series(dtype="float64", index=empty, name="value"), pd.DataFrame(
+            columns=category_order, index=empty, dtype="float64"
+        )
+
+    first_month = months.min()
+    month_index = months - first_month
+    n_months = int(month_index.max()) + 1
+
+    # Category code of every transaction, -1 when its id has no score
+    position = pd.Index(rfm_df["id"]).get_indexer(transactions["id"])
+    codes = rfm_df["Category"].cat.codes.to_numpy().astype("int64")[position]
+    codes[position < 0] = -1
+    categories = rfm_df["Category"].cat.categories
+    size = len(categories)
+    valid = codes >= 0
+
+    by_category = np.bincount(
+        month_index[valid] * size + codes[valid],
+        weights=values[valid],
+        minlength=n_months * size,
+    ).reshape(n_months, size)
+    total = np.bincount(month_index, weights=values, minlength=n_months)
+
+    index = pd.DatetimeIndex(
+        (np.arange(n_months) + first_month).astype("datetime64[M]"), name="date"
+    ) + pd.offsets.MonthEnd(0)
+    by_category = pd.DataFrame(by_category, index=index, columns=list(categories))
+    return pd.Series(total, index=index, name="value"), by_category.reindex(
+        columns=category_order, fill_value=0.0
+    )
+
+
+# Function to list month-end as-of dates in [start_date, end_date]; the end
+# date itself is appended when it is not a month end
+def month_ends(start_date, end_date):
+    start = pd.Timestamp(start_date)
+    end = pd.Timestamp(end_date)
+    dates = pd.date_range(start, end, freq=pd.offsets.MonthEnd())
+    if len(dates) == 0 or dates[-1] != end:
+        dates = dates.append(pd.DatetimeIndex([end]))
+    return dates
+
+
+# Function to score RFM snapshots at a sequence of as-of dates.
+# Every snapshot is answered from the same WindowIndex, so N snapshots cost N
+# index lookups instead of N passes over the transactions.
+# Returns a list of (as_of_date, Category Series indexed by id).
+def segment_snapshots(
+    index,
+    as_of_dates,
+    thresholds=DEFAULT_THRESHOLDS,
+    segments=SEGMENTS,
+    start_date=None,
+):
+    snapshots = []
+    for as_of in as_of_dates:
+        scores = score(index.rfm(start_date, as_of), thresholds, segments)
+        snapshots.append((as_of, scores.set_index("id")["Category"]))
+    return snapshots
+
+
+# Label for customers without a segment at the start of a period
+NEW_CUSTOMERS = "(new)"
+
+
+# Function to count customers moving between segments from one snapshot to
+# the next. Returns a list of (period_start, period_end, matrix) where the
+# matrix rows are the previous segment (plus NEW_CUSTOMERS) and the columns
+# the current one.
+def transition_matrices(snapshots):
+    matrices = []
+    for (previous_date, previous), (as_of, current) in zip(snapshots, snapshots[1:]):
+        categories = list(current.cat.categories)
+        size = len(categories)
+        current_codes = current.cat.codes.to_numpy().astype("int64")
+        # Previous segment of every current customer, -1 when they are new
+        previous_codes = (
+            previous.cat.codes.reindex(current.index).fillna(-1).to_numpy().astype("int64")
+        )
+        counts = np.bincount(
+            (previous_codes + 1) * size + current_codes, minlength=(size + 1) * size
+        ).reshape(size + 1, size)
+        matrix = pd.DataFrame(
+            counts,
+            index=pd.Index([NEW_CUSTOMERS] + categories, name="From"),
+            columns=pd.Index(categories, name="To"),
+        )
+        matrices.append((previous_date, as_of, matrix))
+    return matrices
+
+
+# Function to summarise segment migration over as-of dates.
+# Returns (sizes, matrices): customers per segment at each as-of date and the
+# transition matrix of every period between consecutive dates.
+def segment_migration(
+    index,
+    as_of_dates,
+    thresholds=DEFAULT_THRESHOLDS,
+    segments=SEGMENTS,
+    start_date=None,
+):
+    snapshots = segment_snapshots(index, as_of_dates, thresholds, segments, start_date)
+    sizes = pd.DataFrame(
+        {as_of: categories.value_counts(sort=False) for as_of, categories in snapshots}
+    ).T
+    sizes.index.name = "As of"
+    return sizes, transition_matrices(snapshots)
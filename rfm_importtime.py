@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+
+# Import-time budget check for the app and headless modules.
+# Each module is imported in a fresh interpreter with -X importtime; the check
+# fails when the cumulative import time exceeds its budget or when a heavy
+# dependency that should be loaded on demand is pulled in at import.
+#
+#   python rfm_importtime.py
+
+# Module -> (budget in seconds, top-level packages it must not import)
+IMPORT_BUDGETS = {
+    "rfm_engine": (1.0, ("streamlit", "plotly", "openai")),
+    "rfm_io": (1.0, ("streamlit", "plotly", "openai")),
+    "rfm_cli": (1.0, ("streamlit", "plotly", "openai")),
+    "rfm_recommend": (1.0, ("streamlit", "plotly", "openai")),
+    "rfm_store": (0.5, ("streamlit", "plotly", "openai", "pandas")),
+    # Streamlit registers its Plotly theme on import, so only openai is checked
+    "rfm_cache": (2.0, ("openai",)),
+}
+
+REPEATS = 3
+
+
+# Function to import a module in a fresh interpreter.
+# Returns (cumulative seconds, set of loaded top-level packages).
+def measure_import(module):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    seconds = None
+    loaded = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        name = name.strip()
+        loaded.add(name.split(".")[0])
+        if name == module:
+            seconds = int(cumulative) / 1e6
+    return seconds, loaded
+
+
+def main():
+    failed = False
+    for module, (budget, forbidden) in IMPORT_BUDGETS.items():
+        runs = [measure_import(module) for _ in range(REPEATS)]
+        seconds = min(run[0] for run in runs)
+        unexpected = sorted(set(forbidden) & runs[0][1])
+
+        ok = seconds <= budget and not unexpected
+        failed |= not ok
+        status = "ok" if ok else "FAIL"
+        note = f"  loads {', '.join(unexpected)}" if unexpected else ""
+        print(f"{status:4}  {module:14} {seconds:6.3f}s / {budget:.1f}s{note}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
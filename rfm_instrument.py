@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Lightweight per-stage instrumentation: wall time, rows processed and memory,
+# kept for the debug panel and emitted as structured log lines.
+# When disabled, stage() only yields a throwaway dict.
+#
+# tracemalloc is process-wide while instrumentation is per session, so tracing
+# is reference counted: it runs while any instance is tracking memory. The
+# traced peak can only be reset safely by a sole tracer, so peak_memory_mb is
+# reported only then; memory_delta_mb (net traced change) is always reported.
+
+# Level the JSON timing lines are logged at, e.g. INFO or DEBUG; OFF disables
+# them and unknown names fall back to INFO
+def _timings_level(name):
+    if name == "OFF":
+        return None
+    level = logging.getLevelName(name)
+    return level if isinstance(level, int) else logging.INFO
+
+
+TIMINGS_LEVEL = _timings_level(os.environ.get("RFM_TIMINGS_LOG", "INFO").upper())
+
+logger = logging.getLogger("rfm.timings")
+_logging_lock = threading.Lock()
+_logging_configured = False
+
+
+# Function to make timing lines visible the first time instrumentation is
+# enabled: they go to stderr unless the application has configured logging
+def _configure_logging():
+    global _logging_configured
+    with _logging_lock:
+        if _logging_configured or TIMINGS_LEVEL is None:
+            return
+        _logging_configured = True
+        if logger.level == logging.NOTSET:
+            logger.setLevel(TIMINGS_LEVEL)
+        if not logger.handlers and not logging.getLogger().handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+
+
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+
+
+# Function to register a memory tracer; returns True when it is the only one
+def _start_tracing():
+    global _tracing_users
+    with _tracing_lock:
+        _tracing_users += 1
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return _tracing_users == 1
+
+
+# Function to unregister a memory tracer, stopping tracemalloc after the last
+def _stop_tracing():
+    global _tracing_users
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0 and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+# Function to reset the traced peak if this tracer is the only one
+def _reset_peak():
+    with _tracing_lock:
+        if _tracing_users == 1:
+            tracemalloc.reset_peak()
+            return True
+        return False
+
+
+class Instrumentation:
+    def __init__(self, enabled=False, track_memory=True):
+        self.enabled = enabled
+        self.track_memory = track_memory
+        self.records = []
+        self._tracing = False
+        if enabled:
+            _configure_logging()
+
+    # Function to start timing a stage; returns the record to pass to end()
+    def begin(self, name, rows=None):
+        if not self.enabled:
+            return None
+        record = {"stage": name, "rows": rows, "_start": time.perf_counter()}
+        if self.track_memory:
+            if not self._tracing:
+                _start_tracing()
+                self._tracing = True
+            record["_memory"] = tracemalloc.get_traced_memory()[0]
+            record["_peak"] = _reset_peak()
+        return record
+
+    # Function to finish a stage, store its record and log it
+    def end(self, record, rows=None):
+        if record is None:
+            return
+        record["seconds"] = round(time.perf_counter() - record.pop("_start"), 6)
+        if rows is not None:
+            record["rows"] = rows
+        if "_memory" in record:
+            current, peak = tracemalloc.get_traced_memory()
+            start = record.pop("_memory")
+            own_peak = record.pop("_peak")
+            record["peak_memory_mb"] = round((peak - start) / 2**20, 3) if own_peak else None
+            record["memory_delta_mb"] = round((current - start) / 2**20, 3)
+        self.records.append(record)
+        if TIMINGS_LEVEL is not None:
+            logger.log(TIMINGS_LEVEL, json.dumps(record))
+
+    # Function to time a block; set record["rows"] inside it to report rows
+    @contextmanager
+    def stage(self, name, rows=None):
+        record = self.begin(name, rows)
+        try:
+            yield record if record is not None else {}
+        finally:
+            self.end(record)
+
+    # Function to release this instance's memory tracing; safe to call twice
+    def stop(self):
+        if self._tracing:
+            self._tracing = False
+            _stop_tracing()
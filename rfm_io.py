@@ -0,0 +1,255 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from rfm_engine import (
+    aggregate_transactions,
+    compact_dates,
+    date_timestamps,
+    derive_rfm,
+    filter_transactions,
+    merge_aggregates,
+)
+
+# Transaction load layer: parses the CSV export once and keeps a typed,
+# columnar Feather copy that later runs load memory-mapped. Files too large
+# for memory can be aggregated chunk by chunk with stream_rfm(), and
+# per-customer state can be persisted and updated from daily deltas.
+
+CACHE_DIR = os.environ.get("RFM_CACHE_DIR", ".rfm_cache")
+CHUNKSIZE = 1_000_000
+
+# Columns written back for downstream systems
+OUTPUT_COLUMNS = ["id", "Category", "R_rank", "F_rank", "M_rank"]
+
+# Column dtypes of the parsed transaction table, tried in order.
+# Numeric ids become nullable Int32, anything else (e.g. string ids) categorical;
+# integer dtypes are only used when the values fit them.
+# Dates are stored as int32 days since the epoch (see compact_dates()).
+SCHEMA = {
+    "id": ("Int32", "category"),
+    "num_of_events": ("int16", "int32"),
+    "value": ("float32",),
+}
+
+# Version of the columnar cache layout; a cache written under another SCHEMA
+# or layout is rebuilt even when the source file is unchanged
+CACHE_SCHEMA = hashlib.sha1(
+    json.dumps({"layout": 2, "schema": SCHEMA}, sort_keys=True).encode("utf-8")
+).hexdigest()[:16]
+
+
+# Function to fingerprint a source file by size and mtime, optionally by content hash
+def source_fingerprint(csv_path, use_hash=False):
+    stat = os.stat(csv_path)
+    fingerprint = {
+        "path": os.path.abspath(csv_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    if use_hash:
+        digest = hashlib.sha256()
+        with open(csv_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        fingerprint["sha256"] = digest.hexdigest()
+    return fingerprint
+
+
+# Function to check that numeric values fit an integer dtype; astype() can
+# wrap them silently
+def _fits(values, dtype):
+    dtype = pd.api.types.pandas_dtype(dtype)
+    if not pd.api.types.is_integer_dtype(dtype) or not pd.api.types.is_numeric_dtype(values):
+        return True
+    limits = np.iinfo(getattr(dtype, "numpy_dtype", dtype))
+    return values.count() == 0 or (limits.min <= values.min() and values.max() <= limits.max)
+
+
+# Function to apply SCHEMA to a transaction frame, leaving columns that don't fit as they are
+def apply_schema(df):
+    for column, dtypes in SCHEMA.items():
+        if column not in df.columns:
+            continue
+        for dtype in dtypes:
+            if not _fits(df[column], dtype):
+                continue
+            try:
+                df[column] = df[column].astype(dtype)
+                break
+            except (TypeError, ValueError):
+                pass
+    return df
+
+
+# Function to parse the 'date' column and apply the compact schema to a raw frame
+def parse_transactions(df):
+    # Convert 'date' column to datetime type, then to compact day numbers
+    df["date"] = compact_dates(pd.to_datetime(df["date"]))
+    return apply_schema(df)
+
+
+# Function to parse the transaction CSV into the compact schema
+def read_transactions_csv(csv_path):
+    return parse_transactions(pd.read_csv(csv_path))
+
+
+# Function to parse the transaction CSV in chunks of at most chunksize rows
+def iter_transaction_chunks(csv_path, chunksize=CHUNKSIZE):
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+        yield parse_transactions(chunk)
+
+
+# Function to aggregate a transaction file chunk by chunk.
+# Only per-id running aggregates are kept between chunks, so peak memory
+# grows with the number of customers rather than transactions.
+# Returns (aggregated, max_timestamp).
+def stream_aggregates(csv_path, start_date=None, end_date=None, chunksize=CHUNKSIZE):
+    aggregated = None
+    max_timestamp = 0
+    for chunk in iter_transaction_chunks(csv_path, chunksize):
+        chunk = filter_transactions(chunk, start_date, end_date)
+        max_timestamp = max(max_timestamp, date_timestamps(chunk).max(initial=0))
+        chunk_aggregated = aggregate_transactions(chunk)
+        if aggregated is None:
+            aggregated = chunk_aggregated
+        else:
+            aggregated = merge_aggregates(aggregated, chunk_aggregated)
+    return aggregated, max_timestamp
+
+
+# Function to compute the RFM table from a file larger than memory
+def stream_rfm(csv_path, start_date=None, end_date=None, chunksize=CHUNKSIZE):
+    return derive_rfm(*stream_aggregates(csv_path, start_date, end_date, chunksize))
+
+
+# Function to persist per-customer state: aggregates plus the latest timestamp
+# and the content hashes of the deltas folded in so far
+def save_state(state_path, aggregated, max_timestamp, applied_deltas=()):
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    table = pa.Table.from_pandas(aggregated.reset_index(), preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"rfm_max_timestamp"] = str(int(max_timestamp)).encode()
+    metadata[b"rfm_applied_deltas"] = json.dumps(list(applied_deltas)).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    directory = os.path.dirname(state_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    feather.write_feather(table, state_path + ".tmp", compression="uncompressed")
+    os.replace(state_path + ".tmp", state_path)
+
+
+def _read_state(state_path):
+    import pyarrow.feather as feather
+
+    table = feather.read_table(state_path, memory_map=True)
+    metadata = table.schema.metadata
+    max_timestamp = int(metadata[b"rfm_max_timestamp"])
+    applied_deltas = json.loads(metadata.get(b"rfm_applied_deltas", b"[]"))
+    return table.to_pandas().set_index("id"), max_timestamp, applied_deltas
+
+
+# Function to load per-customer state saved by save_state()
+def load_state(state_path):
+    aggregated, max_timestamp, _ = _read_state(state_path)
+    return aggregated, max_timestamp
+
+
+# Function to list the content hashes of the deltas already in the state
+def applied_deltas(state_path):
+    return _read_state(state_path)[2]
+
+
+# Function to build and persist per-customer state from a full transaction history
+def build_state(state_path, csv_path, chunksize=CHUNKSIZE):
+    aggregated, max_timestamp = stream_aggregates(csv_path, chunksize=chunksize)
+    save_state(state_path, aggregated, max_timestamp)
+    return aggregated, max_timestamp
+
+
+# Function to fold an append-only delta file into persisted state.
+# Only the delta is scanned; Recency is re-derived from the new max date.
+# A delta whose content was already folded in is refused, so a retried job
+# can't count the same transactions twice.
+def update_state(state_path, delta_csv_path, chunksize=CHUNKSIZE):
+    aggregated, max_timestamp, applied = _read_state(state_path)
+    delta_hash = source_fingerprint(delta_csv_path, use_hash=True)["sha256"]
+    if delta_hash in applied:
+        raise ValueError(f"Delta {delta_csv_path} was already applied to {state_path}")
+
+    delta, delta_max_timestamp = stream_aggregates(delta_csv_path, chunksize=chunksize)
+    aggregated = merge_aggregates(aggregated, delta)
+    max_timestamp = max(max_timestamp, delta_max_timestamp)
+    save_state(state_path, aggregated, max_timestamp, applied + [delta_hash])
+    return aggregated, max_timestamp
+
+
+# Function to compute the RFM table from persisted per-customer state
+def rfm_from_state(state_path):
+    return derive_rfm(*load_state(state_path))
+
+
+def _cache_paths(csv_path, cache_dir):
+    stem = hashlib.sha1(os.path.abspath(csv_path).encode("utf-8")).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    base = os.path.join(cache_dir, f"{name}-{stem}")
+    return base + ".feather", base + ".json"
+
+
+# Function to load transactions, using the columnar cache when it matches the
+# source and the current SCHEMA
+def load_transactions(csv_path, cache_dir=CACHE_DIR, use_hash=False):
+    try:
+        import pyarrow.feather as feather
+    except ImportError:
+        return read_transactions_csv(csv_path)
+
+    fingerprint = source_fingerprint(csv_path, use_hash)
+    fingerprint["schema"] = CACHE_SCHEMA
+    data_path, meta_path = _cache_paths(csv_path, cache_dir)
+
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached == fingerprint:
+            return feather.read_table(data_path, memory_map=True).to_pandas()
+    except (OSError, ValueError):
+        pass
+
+    df = read_transactions_csv(csv_path)
+
+    # Write the cache atomically; a read-only location just means no cache
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        feather.write_feather(df, data_path + ".tmp", compression="uncompressed")
+        os.replace(data_path + ".tmp", data_path)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(fingerprint, f)
+        os.replace(meta_path + ".tmp", meta_path)
+    except OSError:
+        pass
+    return df
+
+
+# Function to write segment assignments to CSV or Parquet (by file extension)
+# in blocks of chunksize rows
+def write_scores(scores, output_path, chunksize=CHUNKSIZE):
+    scores = scores[OUTPUT_COLUMNS]
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if output_path.endswith(".parquet"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(scores, preserve_index=False)
+        pq.write_table(table, output_path, row_group_size=chunksize)
+    else:
+        scores.to_csv(output_path, index=False, chunksize=chunksize)
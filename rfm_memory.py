@@ -0,0 +1,70 @@
+import sys
+
+import pandas as pd
+
+from rfm_engine import compute_rfm, score
+from rfm_io import read_transactions_csv
+
+# Memory report for the compact transaction and RFM schemas.
+# Compares bytes per row against pandas defaults (int64/float64 columns,
+# one Python string per customer for RFM_Score and Category) and asserts
+# the minimum savings.
+#
+#   python rfm_memory.py [rfm-data.csv]
+
+MIN_TRANSACTION_RATIO = 2.0
+MIN_RFM_RATIO = 3.0
+
+
+# Function to measure memory per row, including Python objects
+def bytes_per_row(df):
+    return df.memory_usage(index=False, deep=True).sum() / max(len(df), 1)
+
+
+# Function to rebuild a scored RFM table with the dtypes pandas defaults give
+def default_dtypes(scores):
+    return scores.astype(
+        {
+            "id": "float64",
+            "Recency": "int64",
+            "Monetary": "float64",
+            "Frequency": "float64",
+            "AOS": "float64",
+            "R_rank": "int64",
+            "F_rank": "int64",
+            "M_rank": "int64",
+            "RFM_Score": "int64",
+            "Category": "object",
+        }
+    ).assign(RFM_Score=lambda df: df["RFM_Score"].astype(str).astype("object"))
+
+
+def memory_report(csv_path):
+    default_transactions = pd.read_csv(csv_path)
+    default_transactions["date"] = pd.to_datetime(default_transactions["date"])
+    transactions = read_transactions_csv(csv_path)
+    scores = score(compute_rfm(transactions))
+
+    return {
+        "transaction": (bytes_per_row(default_transactions), bytes_per_row(transactions)),
+        "customer": (bytes_per_row(default_dtypes(scores)), bytes_per_row(scores)),
+    }
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    csv_path = argv[0] if argv else "rfm-data.csv"
+    report = memory_report(csv_path)
+
+    for name, (default, compact) in report.items():
+        print(f"{name:12} {default:8.1f} B -> {compact:6.1f} B  ({default / compact:.1f}x)")
+
+    default, compact = report["transaction"]
+    assert default / compact >= MIN_TRANSACTION_RATIO, "transaction frame not compact"
+    default, compact = report["customer"]
+    assert default / compact >= MIN_RFM_RATIO, "RFM frame not compact"
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from rfm_engine import segment_profile
+
+# Segment recommendations from the OpenAI chat API. Calls run on a background
+# thread with a timeout, and responses are cached on disk keyed by a hash of
+# the prompt and the per-segment summary it is built from, so repeated visits
+# return instantly.
+# Set OPENAI_API_BASE (or pass api_base) to point at a local stub endpoint.
+
+MODEL = "gpt-3.5-turbo-16k"
+REQUEST_TIMEOUT_SECONDS = int(os.environ.get("RFM_RECOMMENDATION_TIMEOUT", 60))
+# How long the app waits for a running request before returning to the user
+WAIT_SECONDS = int(os.environ.get("RFM_RECOMMENDATION_WAIT", 15))
+CACHE_DIR = os.path.join(
+    os.environ.get("RFM_CACHE_DIR", ".rfm_cache"), "recommendations"
+)
+
+# Fixed instructions of the prompt, built once
+PROMPT_INSTRUCTIONS = (
+    "Based on the RFM analysis, provide a detailed and comprehensive description of the customers across all 11 segments. You are data analyst with perfect business feeling. "
+    "Analyze each segment individually, following this specific category order and structure:\n\n"
+
+    "Champions:\n"
+    "Customer Value:\n"
+    "    1 key sentence about this category business\n"
+    "Engagement Recommendations:\n"
+    "    Provide 2 key recommendations on how to engage with Champions.\n\n"
+
+    "Loyal Customers:\n"
+    "Customer Value:\n"
+    "    1 key sentence about this category business\n"
+    "Engagement Recommendations:\n"
+    "    Provide 2 key recommendations on how to engage with Loyal Customers.\n\n"
+
+    "Potential Loyalists:\n"
+    "Customer Value:\n"
+    "    1 key sentence about this category business\n"
+    "Engagement Recommendations:\n"
+    "    Provide 2 key recommendations on how to engage with Potential Loyalists.\n\n"
+
+    "Recent Customers:\n"
+    "Customer Value:\n"
+    "    1 key sentence about this category business\n"
+    "Engagement Recommendations:\n"
+    "    Provide 2 key recommendations on how to engage with Recent Customers.\n\n"
+
+    "Promising:\n"
+    "Customer Value:\n"
+    "    1 key sentence about this category business\n"
+    "Engagement Recommendations:\n"
+    "    Provide 2 key recommendations on how to engage with Promising customers.\n\n"
+
+    "Need Attention:\n"
+    "Customer Value:\n"
+    "    1 key sentence about this category business\n"
+    "Engagement Recommendations:\n"
+    "    Provide 2 key recommendations on how to engage with customers who Need Attention.\n\n"
+
+    "About to Sleep:\n"
+    "Customer Value:\n"
+    "    1 key sentence about this category business\n"
+    "Engagement Recommendations:\n"
+    "    Provide 2 key recommendations on how to engage with customers who are About to Sleep.\n\n"
+
+    "Can't Lose:\n"
+    "Customer Value:\n"
+    "    1 key sentence about this category business\n"
+    "Engagement Recommendations:\n"
+    "    Provide 2 key recommendations on how to engage with customers who Can't Lose.\n\n"
+
+    "At Risk:\n"
+    "Customer Value:\n"
+    "    1 key sentence about this category business\n"
+    "Engagement Recommendations:\n"
+    "    Provide 2 key recommendations on how to engage with customers who are At Risk.\n\n"
+
+    "Hibernating:\n"
+    "Customer Value:\n"
+    "    1 key sentence about this category business\n"
+    "Engagement Recommendations:\n"
+    "    Provide 2 key recommendations on how to engage with Hibernating customers.\n\n"
+
+    "Lost:\n"
+    "Customer Value:\n"
+    "    1 key sentence about this category business\n"
+    "Engagement Recommendations:\n"
+    "    Provide 2 key recommendations on how to engage with Lost customers.\n\n"
+
+    "! Make all names of Category bold\n"
+    "! Make all names like customer value and engagement recommendations bold\n"
+    "! Didnt use word RFM skore\n"
+    "! Follow the structure\n"
+)
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="rfm-recommend")
+# In-flight requests by cache key, shared by reruns and sessions
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+class RecommendationError(Exception):
+    pass
+
+
+# Function to summarise each segment as a compact fixed-size CSV table
+def segment_summary(rfm_df):
+    profile = segment_profile(rfm_df).round(
+        {
+            "Revenue": 0,
+            "Revenue_Share_Pct": 1,
+            "Median_Recency": 0,
+            "Median_Frequency": 1,
+            "Median_Monetary": 0,
+            "Mean_AOS": 0,
+        }
+    )
+    return profile.to_csv(index=False)
+
+
+# Function to build the full prompt around the per-segment summary, so its
+# size does not depend on the number of customers
+def build_prompt(summary):
+    return (
+        PROMPT_INSTRUCTIONS
+        + "Here is the data, one row per segment (Frequency is days between purchases, "
+        + f"AOS is the average order size):\n{summary}"
+    )
+
+
+# Function to hash the prompt and segment summary into a cache key
+def cache_key(prompt, summary):
+    payload = json.dumps([MODEL, prompt, summary], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _cache_path(key, cache_dir):
+    return os.path.join(cache_dir, key + ".json")
+
+
+# Function to read a cached recommendation, or None
+def cached_recommendation(key, cache_dir=CACHE_DIR):
+    try:
+        with open(_cache_path(key, cache_dir), encoding="utf-8") as f:
+            return json.load(f)["content"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _store_recommendation(key, content, cache_dir):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = _cache_path(key, cache_dir)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"content": content}, f)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+
+# Function to call the chat API and return the recommendation text
+def request_recommendation(prompt, api_key, api_base=None, timeout=REQUEST_TIMEOUT_SECONDS):
+    # The OpenAI client is only loaded when a request is actually made
+    import openai
+
+    try:
+        response = openai.ChatCompletion.create(
+            model=MODEL,
+            messages=[
+                {"role": "system", "content": "You are a data analyst."},
+                {"role": "user", "content": prompt},
+            ],
+            max_tokens=1000,  # Increase the number of max tokens
+            temperature=0.7,  # Adjust the temperature for more creative responses
+            api_key=api_key,
+            api_base=api_base or os.environ.get("OPENAI_API_BASE") or openai.api_base,
+            request_timeout=timeout,
+        )
+    except openai.error.RateLimitError:
+        raise RecommendationError(
+            "You have exceeded your OpenAI API quota. Please check your plan and billing details."
+        )
+    except openai.error.PermissionError:
+        raise RecommendationError(
+            "You have insufficient permissions for this operation. Please check your API key permissions."
+        )
+    except openai.error.Timeout:
+        raise RecommendationError(f"OpenAI request timed out after {timeout} seconds.")
+    except openai.error.OpenAIError as e:
+        raise RecommendationError(f"Error with OpenAI request: {e}")
+
+    # Check the structure of the response
+    if "choices" in response and len(response["choices"]) > 0:
+        return response["choices"][0]["message"]["content"].strip()
+    raise RecommendationError("Unexpected API response structure")
+
+
+def _fetch_and_store(key, prompt, api_key, api_base, timeout, cache_dir):
+    content = request_recommendation(prompt, api_key, api_base, timeout)
+    _store_recommendation(key, content, cache_dir)
+    return content
+
+
+# Function to get a recommendation without blocking: returns a Future that is
+# already resolved on a cache hit, joins a request still in flight for the
+# same key, or starts a new request in the background
+def submit_recommendation(
+    rfm_df,
+    api_key,
+    api_base=None,
+    timeout=REQUEST_TIMEOUT_SECONDS,
+    cache_dir=CACHE_DIR,
+):
+    summary = segment_summary(rfm_df)
+    prompt = build_prompt(summary)
+    key = cache_key(prompt, summary)
+
+    content = cached_recommendation(key, cache_dir)
+    if content is not None:
+        future = Future()
+        future.set_result(content)
+        return future
+
+    with _pending_lock:
+        future = _pending.get(key)
+        if future is not None and not future.done():
+            return future
+        future = _executor.submit(
+            _fetch_and_store, key, prompt, api_key, api_base, timeout, cache_dir
+        )
+        _pending[key] = future
+    # Registered outside the lock: the callback runs here if already done
+    future.add_done_callback(lambda done: _forget(key, done))
+    return future
+
+
+# Function to drop a finished request, unless a newer one took its key
+def _forget(key, future):
+    with _pending_lock:
+        if _pending.get(key) is future:
+            del _pending[key]
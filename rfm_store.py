@@ -0,0 +1,94 @@
+import threading
+import weakref
+
+# Process-wide store of read-only data shared by all dashboard sessions.
+# Every entry is built once and reference counted: a session holds at most one
+# reference per slot (e.g. "transactions", "scores") and gives it back when it
+# moves to another key or ends, and the entry is dropped when nobody holds it.
+# Memory therefore grows with the distinct keys in use, not with sessions.
+# Shared values must be treated as read-only by every holder.
+
+
+class SharedStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._refs = {}
+        self._building = {}
+
+    # Function to take a reference to the value of key, building it with
+    # factory() on first use. Concurrent first uses build it only once.
+    def acquire(self, key, factory):
+        with self._lock:
+            if key in self._entries:
+                self._refs[key] += 1
+                return self._entries[key]
+            build_lock = self._building.setdefault(key, threading.Lock())
+
+        with build_lock:
+            with self._lock:
+                if key in self._entries:
+                    self._refs[key] += 1
+                    return self._entries[key]
+            try:
+                value = factory()
+            except BaseException:
+                # Nothing is stored; the next acquire builds again
+                with self._lock:
+                    self._building.pop(key, None)
+                raise
+            with self._lock:
+                self._entries[key] = value
+                self._refs[key] = 1
+                self._building.pop(key, None)
+            return value
+
+    # Function to give back a reference; the entry is dropped at zero
+    def release(self, key):
+        with self._lock:
+            if key not in self._refs:
+                return
+            self._refs[key] -= 1
+            if self._refs[key] <= 0:
+                del self._refs[key]
+                del self._entries[key]
+
+    # Function to list the live entries with their reference counts
+    def stats(self):
+        with self._lock:
+            return dict(self._refs)
+
+
+# References held by one session, one per slot. Taking a new key for a slot
+# releases the previous one; everything is released when the object is
+# garbage collected with its session.
+class SessionHandles:
+    def __init__(self, store):
+        self.store = store
+        self._keys = {}
+        self._values = {}
+        weakref.finalize(self, _release_all, store, self._keys)
+
+    # Function to return the shared value of key for slot, acquiring it when
+    # the slot held a different key before
+    def get(self, slot, key, factory):
+        if self._keys.get(slot) == key:
+            return self._values[slot]
+        value = self.store.acquire(key, factory)
+        previous = self._keys.get(slot)
+        self._keys[slot] = key
+        self._values[slot] = value
+        if previous is not None:
+            self.store.release(previous)
+        return value
+
+    # Function to give back every reference of this session
+    def close(self):
+        _release_all(self.store, self._keys)
+        self._values.clear()
+
+
+def _release_all(store, keys):
+    for key in keys.values():
+        store.release(key)
+    keys.clear()
@@ -1,117 +1,61 @@
 import streamlit as st
 import pandas as pd
-from datetime import datetime, timedelta
-import plotly.express as px
-import plotly.graph_objects as go
-import re
+
+from rfm_cache import cached_auto_thresholds, cached_scores, cached_transactions, fingerprint
+from rfm_engine import DEFAULT_THRESHOLDS, Thresholds, category_order, date_span, sample_by_category
+from rfm_instrument import Instrumentation
 
 # Application title with colored text
 st.markdown("""
 # RFM by <span style="color:dodgerblue">Keboola</span>
 """, unsafe_allow_html=True)
 
-# Function to assign categories based on R and F scores using regex
-def assign_category(r, f):
-    rfm_score = f"{r}{f}"
-    if re.match(r'5[4-5]', rfm_score):
-        return '01. Champions'
-    elif re.match(r'[3-4][4-5]', rfm_score):
-        return '02. Loyal Customers'
-    elif re.match(r'[4-5][2-3]', rfm_score):
-        return '03. Potential Loyalists'
-    elif re.match(r'51', rfm_score):
-        return '04. Recent Customers'
-    elif re.match(r'41', rfm_score):
-        return '05. Promising'
-    elif re.match(r'33', rfm_score):
-        return '06. Need Attention'
-    elif re.match(r'3[1-2]', rfm_score):
-        return '07. About to Sleep'
-    elif re.match(r'[1-2][5]', rfm_score):
-        return '08. Can\'t Lose'
-    elif re.match(r'[1-2][3-4]', rfm_score):
-        return '09. At Risk'
-    elif re.match(r'2[1-2]', rfm_score):
-        return '10. Hibernating'
-    elif re.match(r'1[1-2]', rfm_score):
-        return '11. Lost'
-    else:
-        return 'Uncategorized'
-
 # Load CSV file
 csv_path = "in/tables/rfm_data.csv"
+
+# Optional per-stage timings, shown in a sidebar expander and logged
+instrumentation = Instrumentation(st.sidebar.checkbox('Show pipeline timings', False))
 try:
-    df = pd.read_csv(csv_path)
-    
-    # Convert 'date' column to datetime type
-    df['date'] = pd.to_datetime(df['date'])
+    with instrumentation.stage('load') as record:
+        source_key = fingerprint(csv_path)
+        df = cached_transactions(csv_path, source_key)
+        record['rows'] = len(df)
     
     # Create interactive date selection fields in the sidebar
-    start_date = st.sidebar.date_input('Start date', df['date'].min().date())
-    end_date = st.sidebar.date_input('End date', df['date'].max().date())
+    first_date, last_date = date_span(df)
+    start_date = st.sidebar.date_input('Start date', first_date.date())
+    end_date = st.sidebar.date_input('End date', last_date.date())
 
-    # Filter data based on selected dates
-    filtered_df = df[(df['date'] >= pd.to_datetime(start_date)) & (df['date'] <= pd.to_datetime(end_date))]
-    
     # Add text inputs for R, F, M quantile boundaries in the sidebar
     st.sidebar.markdown("### Adjust RFM Quantile Boundaries")
+    defaults = DEFAULT_THRESHOLDS
+    if st.sidebar.checkbox('Auto thresholds (quintiles)', False):
+        with instrumentation.stage('auto thresholds'):
+            defaults = cached_auto_thresholds(csv_path, source_key, start_date, end_date)
     r_quantiles = [
-        int(st.sidebar.text_input('R5', value=3)),
-        int(st.sidebar.text_input('R4', value=10)),
-        int(st.sidebar.text_input('R3', value=25)),
-        int(st.sidebar.text_input('R2', value=66)),
-        int(st.sidebar.text_input('R1', value=100))
+        int(st.sidebar.text_input('R5', value=defaults.recency[0])),
+        int(st.sidebar.text_input('R4', value=defaults.recency[1])),
+        int(st.sidebar.text_input('R3', value=defaults.recency[2])),
+        int(st.sidebar.text_input('R2', value=defaults.recency[3]))
     ]
     f_quantiles = [
-        float(st.sidebar.text_input('F5', value=13.6)),
-        float(st.sidebar.text_input('F4', value=24.5)),
-        float(st.sidebar.text_input('F3', value=38.8)),
-        float(st.sidebar.text_input('F2', value=66.6)),
-        float(st.sidebar.text_input('F1', value=100))
+        float(st.sidebar.text_input('F5', value=defaults.frequency[0])),
+        float(st.sidebar.text_input('F4', value=defaults.frequency[1])),
+        float(st.sidebar.text_input('F3', value=defaults.frequency[2])),
+        float(st.sidebar.text_input('F2', value=defaults.frequency[3]))
     ]
     m_quantiles = [
-        int(st.sidebar.text_input('M5', value=6841)),
-        int(st.sidebar.text_input('M4', value=3079)),
-        int(st.sidebar.text_input('M3', value=1573)),
-        int(st.sidebar.text_input('M2', value=672)),
-        int(st.sidebar.text_input('M1', value=1))
+        float(st.sidebar.text_input('M5', value=defaults.monetary[0])),
+        float(st.sidebar.text_input('M4', value=defaults.monetary[1])),
+        float(st.sidebar.text_input('M3', value=defaults.monetary[2])),
+        float(st.sidebar.text_input('M2', value=defaults.monetary[3]))
     ]
     
-    # Calculate RFM values
-    max_date = filtered_df['date'].max() + timedelta(days=1)
-    rfm_df = filtered_df.groupby('id').agg({
-        'date': lambda x: (max_date - x.max()).days,
-        'id': 'count',
-        'value': 'sum'
-    }).rename(columns={
-        'date': 'Recency',
-        'id': 'Frequency',
-        'value': 'Monetary'
-    }).reset_index()
-    
-    # Assign quantile ranks based on custom boundaries
-    rfm_df['R_rank'] = pd.cut(rfm_df['Recency'], bins=[0] + r_quantiles[::-1], labels=False, include_lowest=True) + 1
-    rfm_df['F_rank'] = pd.cut(rfm_df['Frequency'], bins=[0] + f_quantiles, labels=False, include_lowest=True) + 1
-    rfm_df['M_rank'] = pd.cut(rfm_df['Monetary'], bins=[0] + m_quantiles, labels=False, include_lowest=True) + 1
-
-    # Convert ranks to str for concatenation
-    rfm_df['R_rank'] = (6 - rfm_df['R_rank']).astype(str)  # Reverse the R rank
-    rfm_df['F_rank'] = rfm_df['F_rank'].astype(str)
-    rfm_df['M_rank'] = rfm_df['M_rank'].astype(str)
-    
-    rfm_df['RFM_Score'] = rfm_df['R_rank'] + rfm_df['F_rank'] + rfm_df['M_rank']
-
-    # Assign categories based on R and F scores using regex
-    rfm_df['Category'] = rfm_df.apply(lambda x: assign_category(x['R_rank'], x['F_rank']), axis=1)
-
-    # Sort categories by numeric order
-    category_order = [
-        '01. Champions', '02. Loyal Customers', '03. Potential Loyalists',
-        '04. Recent Customers', '05. Promising', '06. Need Attention',
-        '07. About to Sleep', '08. Can\'t Lose', '09. At Risk',
-        '10. Hibernating', '11. Lost'
-    ]
-    rfm_df['Category'] = pd.Categorical(rfm_df['Category'], categories=category_order, ordered=True)
+    # Calculate RFM values and assign ranks and categories
+    thresholds = Thresholds(tuple(r_quantiles), tuple(f_quantiles), tuple(m_quantiles))
+    with instrumentation.stage('rfm + score') as record:
+        rfm_df = cached_scores(csv_path, source_key, start_date, end_date, thresholds)
+        record['rows'] = len(rfm_df)
 
     # CSS for styling buttons
     st.markdown("""
@@ -172,29 +116,38 @@ try:
     # Filter data based on the selected categories
     filtered_category_df = rfm_df
 
+    # Chart libraries are imported once a view is about to be drawn, so the
+    # data load and sidebar do not wait for them
+    import plotly.express as px
+    import plotly.graph_objects as go
+
+    from rfm_charts import box_figure, histogram_figure
+
+    # Time the selected view, including building its figures
+    view_record = instrumentation.begin(f'view: {selected_button}', len(rfm_df))
+
     if selected_button == 'Recency':
-        fig1 = px.histogram(filtered_category_df, x='Recency', title='Histogram Recency', color='Category', category_orders={'Category': category_order}, color_discrete_sequence=px.colors.qualitative.Pastel)
-        fig2 = px.box(filtered_category_df, y='Recency', title='Boxplot Recency', color='Category', category_orders={'Category': category_order}, color_discrete_sequence=px.colors.qualitative.Pastel)
+        fig1 = histogram_figure(filtered_category_df, 'Recency', 'Histogram Recency')
+        fig2 = box_figure(filtered_category_df, 'Recency', 'Boxplot Recency')
         st.plotly_chart(fig1)
         st.plotly_chart(fig2)
         st.markdown("<p style='font-size: small;'>Recency shows how recently each customer made a purchase.</p>", unsafe_allow_html=True)
 
     if selected_button == 'Frequency':
-        fig1 = px.histogram(filtered_category_df, x='Frequency', title='Histogram Frequency', color='Category', category_orders={'Category': category_order}, color_discrete_sequence=px.colors.qualitative.Pastel)
-        fig2 = px.box(filtered_category_df, y='Frequency', title='Boxplot Frequency', color='Category', category_orders={'Category': category_order}, color_discrete_sequence=px.colors.qualitative.Pastel)
+        fig1 = histogram_figure(filtered_category_df, 'Frequency', 'Histogram Frequency')
+        fig2 = box_figure(filtered_category_df, 'Frequency', 'Boxplot Frequency')
         st.plotly_chart(fig1)
         st.plotly_chart(fig2)
         st.markdown("<p style='font-size: small;'>Frequency shows how often each customer makes a purchase.</p>", unsafe_allow_html=True)
 
     if selected_button == 'Monetary':
-        fig1 = px.histogram(filtered_category_df, x='Monetary', title='Histogram Monetary', color='Category', category_orders={'Category': category_order}, color_discrete_sequence=px.colors.qualitative.Pastel)
-        fig2 = px.box(filtered_category_df, y='Monetary', title='Boxplot Monetary', color='Category', category_orders={'Category': category_order}, color_discrete_sequence=px.colors.qualitative.Pastel)
+        fig1 = histogram_figure(filtered_category_df, 'Monetary', 'Histogram Monetary')
+        fig2 = box_figure(filtered_category_df, 'Monetary', 'Boxplot Monetary')
         st.plotly_chart(fig1)
         st.plotly_chart(fig2)
         st.markdown("<p style='font-size: small;'>Monetary shows how much money each customer spends.</p>", unsafe_allow_html=True)
 
         # Calculate and plot Average Order Size (AOS)
-        filtered_category_df['AOS'] = filtered_category_df['Monetary'] / filtered_category_df['Frequency']
         aos_df = filtered_category_df.groupby('Category').agg({'AOS': 'mean'}).reset_index()
 
         fig3 = px.bar(aos_df, x='Category', y='AOS', title='Average Order Size (AOS) by Category', color='Category', 
@@ -202,20 +155,26 @@ try:
         st.plotly_chart(fig3)
         st.markdown("<p style='font-size: small;'>Average Order Size (AOS) shows the average amount spent per order in each category.</p>", unsafe_allow_html=True)
 
+    # Stratified sample per category keeps scatter payloads bounded
+    if selected_button.startswith('Scatter') or selected_button == '3D Scatter Plot':
+        scatter_df = sample_by_category(filtered_category_df)
+        if len(scatter_df) < len(filtered_category_df):
+            st.markdown(f"<p style='font-size: small;'>Showing a stratified sample of {len(scatter_df)} of {len(filtered_category_df)} customers.</p>", unsafe_allow_html=True)
+
     if selected_button == 'Scatter Recency vs Frequency':
-        fig = px.scatter(filtered_category_df, x='Recency', y='Frequency', title='Scatter Recency vs Frequency', color='Category', category_orders={'Category': category_order}, color_discrete_sequence=px.colors.qualitative.Pastel)
+        fig = px.scatter(scatter_df, x='Recency', y='Frequency', title='Scatter Recency vs Frequency', color='Category', category_orders={'Category': category_order}, color_discrete_sequence=px.colors.qualitative.Pastel)
         st.plotly_chart(fig)
 
     if selected_button == 'Scatter Frequency vs Monetary':
-        fig = px.scatter(filtered_category_df, x='Frequency', y='Monetary', title='Scatter Frequency vs Monetary', color='Category', category_orders={'Category': category_order}, color_discrete_sequence=px.colors.qualitative.Pastel)
+        fig = px.scatter(scatter_df, x='Frequency', y='Monetary', title='Scatter Frequency vs Monetary', color='Category', category_orders={'Category': category_order}, color_discrete_sequence=px.colors.qualitative.Pastel)
         st.plotly_chart(fig)
 
     if selected_button == 'Scatter Recency vs Monetary':
-        fig = px.scatter(filtered_category_df, x='Recency', y='Monetary', title='Scatter Recency vs Monetary', color='Category', category_orders={'Category': category_order}, color_discrete_sequence=px.colors.qualitative.Pastel)
+        fig = px.scatter(scatter_df, x='Recency', y='Monetary', title='Scatter Recency vs Monetary', color='Category', category_orders={'Category': category_order}, color_discrete_sequence=px.colors.qualitative.Pastel)
         st.plotly_chart(fig)
 
     if selected_button == '3D Scatter Plot':
-        fig = px.scatter_3d(filtered_category_df, x='Recency', y='Frequency', z='Monetary',
+        fig = px.scatter_3d(scatter_df, x='Recency', y='Frequency', z='Monetary',
                             color='Category', 
                             title='3D Scatter Plot of Recency, Frequency, and Monetary',
                             height=800, category_orders={'Category': category_order}, color_discrete_sequence=px.colors.qualitative.Pastel)  # Increase height for better visualization
@@ -296,7 +255,17 @@ try:
         fig = px.imshow(heatmap_data, title='Heatmap of Recency and Frequency', color_continuous_scale='Blues')
         st.plotly_chart(fig)
 
+    instrumentation.end(view_record)
+
+    # Debug panel with the timings recorded during this run
+    if instrumentation.enabled:
+        with st.sidebar.expander('Pipeline timings', expanded=True):
+            st.dataframe(pd.DataFrame(instrumentation.records))
+
 except FileNotFoundError:
     st.error(f"File not found at path {csv_path}.")
 except Exception as e:
     st.error(f"An error occurred while loading the file: {e}")
+finally:
+    # Memory tracing is process-wide; release it even when a view fails
+    instrumentation.stop()
@@ -0,0 +1,24 @@
+import os
+
+import pandas as pd
+import pytest
+
+from rfm_cli import main, parse_args
+
+SAMPLE_CSV = os.path.join(os.path.dirname(os.path.dirname(__file__)), "rfm-data.csv")
+
+
+def test_stream_rejects_workers(capsys):
+    with pytest.raises(SystemExit):
+        parse_args([SAMPLE_CSV, "out.csv", "--stream", "--workers", "4"])
+    assert "--workers can't be combined with --stream" in capsys.readouterr().err
+    assert parse_args([SAMPLE_CSV, "out.csv", "--stream"]).workers == 1
+
+
+def test_stream_and_load_write_the_same_segments(tmp_path, monkeypatch):
+    # The columnar cache goes to .rfm_cache in the working directory
+    monkeypatch.chdir(tmp_path)
+    loaded, streamed = str(tmp_path / "loaded.csv"), str(tmp_path / "streamed.csv")
+    assert main([SAMPLE_CSV, loaded, "--thresholds", "auto"]) == 0
+    assert main([SAMPLE_CSV, streamed, "--thresholds", "auto", "--stream"]) == 0
+    pd.testing.assert_frame_equal(pd.read_csv(streamed), pd.read_csv(loaded))
@@ -0,0 +1,261 @@
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from rfm_engine import (
+    DEFAULT_THRESHOLDS,
+    FREQUENCY_GRID,
+    NEW_CUSTOMERS,
+    OBJECTIVES,
+    SEGMENTS,
+    UNCATEGORIZED,
+    Thresholds,
+    WindowIndex,
+    auto_thresholds,
+    compute_rfm,
+    cube_category_totals,
+    date_span,
+    month_ends,
+    optimize_thresholds,
+    rfm_cube,
+    sample_by_cell,
+    score,
+    score_cube,
+    segment_migration,
+    segment_snapshots,
+    snap_thresholds,
+)
+from rfm_io import read_transactions_csv, stream_rfm
+
+SAMPLE_CSV = os.path.join(os.path.dirname(os.path.dirname(__file__)), "rfm-data.csv")
+
+
+# Copy of the per-row scorer that rfm.py used before the engine existed
+def legacy_assign_category(r, f):
+    rfm_score = f"{r}{f}"
+    for pattern, category in SEGMENTS.items():
+        if re.match(pattern, rfm_score):
+            return category
+    return UNCATEGORIZED
+
+
+def legacy_recalculate_rfm(rfm_df, recency_thresholds, frequency_thresholds, monetary_thresholds):
+    rfm_df = rfm_df.copy()
+    rfm_df["R_rank"] = rfm_df["Recency"].apply(
+        lambda x: next((5 - i for i, t in enumerate(recency_thresholds) if x <= t), 1)
+    )
+
+    def calculate_f_rank(frequency):
+        for i, threshold in enumerate(frequency_thresholds, start=1):
+            if frequency <= threshold:
+                return 6 - i
+        return 1
+
+    rfm_df["F_rank"] = rfm_df["Frequency"].apply(calculate_f_rank)
+
+    rfm_df["M_rank"] = rfm_df["AOS"].apply(
+        lambda x: next((5 - i for i, t in enumerate(monetary_thresholds) if x >= t), 1)
+    )
+
+    rfm_df["RFM_Score"] = rfm_df["R_rank"].astype(str) + rfm_df["F_rank"].astype(str)
+
+    rfm_df["Category"] = rfm_df.apply(
+        lambda x: legacy_assign_category(x["R_rank"], x["F_rank"]), axis=1
+    )
+
+    return rfm_df
+
+
+THRESHOLD_SETS = [
+    DEFAULT_THRESHOLDS,
+    # Unsorted lists: the first threshold matched wins, as in the lambdas
+    Thresholds((25, 3, 66, 10), (38.8, 13.6, 66.6, 24.5), (672, 6841, 1573, 3079)),
+    # Repeated thresholds
+    Thresholds((10, 10, 25, 25), (13.6, 13.6, 13.6, 66.6), (3079, 3079, 672, 672)),
+    # Fewer and more than four thresholds
+    Thresholds((10, 25, 66), (24.5, 38.8, 66.6), (3079, 1573, 672)),
+    Thresholds((3, 10, 25, 66, 100), (13.6, 24.5, 38.8, 66.6, 80), (6841, 3079, 1573, 672, 300)),
+]
+
+
+# Function to build an RFM table with values on, just below and just above every
+# threshold of every set, plus NaN
+def boundary_rfm():
+    recency, frequency, monetary = set(), set(), set()
+    for thresholds in THRESHOLD_SETS:
+        for t in thresholds.recency:
+            recency.update((t - 1, t, t + 1))
+        for t in thresholds.frequency:
+            frequency.update((t - 0.1, t, t + 0.1))
+        for t in thresholds.monetary:
+            monetary.update((t - 0.01, t, t + 0.01))
+    recency, frequency, aos = (
+        sorted(values) + [0, 10_000, np.nan] for values in (recency, frequency, monetary)
+    )
+    size = max(map(len, (recency, frequency, aos)))
+    rng = np.random.default_rng(0)
+    rows = pd.DataFrame(
+        {
+            "id": np.arange(size * 4),
+            "Recency": rng.permutation(np.resize(recency, size * 4)),
+            "Frequency": rng.permutation(np.resize(frequency, size * 4)),
+            "AOS": rng.permutation(np.resize(aos, size * 4)),
+        }
+    )
+    rows["Monetary"] = rows["AOS"] * rows["Frequency"]
+    return rows
+
+
+def assert_same_scores(scores, legacy):
+    for column in ("R_rank", "F_rank", "M_rank"):
+        np.testing.assert_array_equal(scores[column].to_numpy(), legacy[column].to_numpy())
+    assert (scores["RFM_Score"].astype(str) == legacy["RFM_Score"]).all()
+    assert (scores["Category"].astype(str) == legacy["Category"]).all()
+
+
+@pytest.mark.parametrize("thresholds", THRESHOLD_SETS)
+def test_score_matches_legacy_lambdas_on_boundaries(thresholds):
+    rfm_df = boundary_rfm()
+    legacy = legacy_recalculate_rfm(rfm_df, *thresholds)
+    assert_same_scores(score(rfm_df, thresholds), legacy)
+
+
+@pytest.mark.parametrize("thresholds", THRESHOLD_SETS)
+def test_score_on_float32_columns_matches_legacy_float64(thresholds):
+    # The engine stores Frequency and AOS as float32; a value equal to a
+    # threshold must still rank as equal after rounding
+    rfm_df = boundary_rfm()
+    legacy = legacy_recalculate_rfm(rfm_df, *thresholds)
+    compact = rfm_df.astype({"Recency": "float32", "Frequency": "float32", "AOS": "float32"})
+    assert_same_scores(score(compact, thresholds), legacy)
+
+
+def test_score_matches_legacy_on_sample_data():
+    rfm_df = compute_rfm(read_transactions_csv(SAMPLE_CSV))
+    legacy = legacy_recalculate_rfm(
+        rfm_df.astype({"Frequency": "float64", "AOS": "float64"}), *DEFAULT_THRESHOLDS
+    )
+    assert_same_scores(score(rfm_df), legacy)
+
+
+@pytest.fixture(scope="module")
+def transactions():
+    return read_transactions_csv(SAMPLE_CSV)
+
+
+@pytest.mark.parametrize(
+    "window", [(None, None), ("2011-01-01", "2011-06-30"), ("2011-03-05 12:00", "2011-09-01")]
+)
+def test_rfm_paths_agree(transactions, window):
+    expected = compute_rfm(transactions, *window)
+    index_rfm = WindowIndex(transactions).rfm(*window)
+    pd.testing.assert_frame_equal(index_rfm, expected)
+    pd.testing.assert_frame_equal(compute_rfm(transactions, *window, workers=2), expected)
+    pd.testing.assert_frame_equal(stream_rfm(SAMPLE_CSV, *window, chunksize=3000), expected)
+
+
+def test_compact_and_datetime_dates_agree(transactions):
+    dated = transactions.assign(date=pd.to_datetime(transactions["date"], unit="D"))
+    for window in [(None, None), ("2011-02-01", "2011-10-31")]:
+        pd.testing.assert_frame_equal(
+            compute_rfm(dated, *window), compute_rfm(transactions, *window)
+        )
+
+
+def test_cube_counts_match_per_customer_scoring(transactions):
+    rfm_df = compute_rfm(transactions)
+    cube = rfm_cube(rfm_df)
+    rng = np.random.default_rng(0)
+    threshold_sets = [DEFAULT_THRESHOLDS, auto_thresholds(rfm_df)] + [
+        snap_thresholds(
+            Thresholds(
+                tuple(int(t) for t in np.sort(rng.integers(1, 200, 4))),
+                tuple(float(t) for t in np.sort(np.round(rng.uniform(1, 80, 4), 2))),
+                DEFAULT_THRESHOLDS.monetary,
+            )
+        )
+        for _ in range(50)
+    ]
+    for thresholds in threshold_sets:
+        scores = score(rfm_df, thresholds)
+        totals = cube_category_totals(score_cube(cube, thresholds)).set_index("Category")
+        expected = scores.groupby("Category", observed=False)["Monetary"].agg(["size", "sum"])
+        expected = expected.reindex(totals.index, fill_value=0)
+        np.testing.assert_array_equal(totals["Customers"], expected["size"])
+        np.testing.assert_allclose(totals["Monetary"], expected["sum"], rtol=1e-9)
+
+
+def test_cell_sample_shows_every_tuned_category(transactions):
+    rfm_df = compute_rfm(transactions)
+    sample = sample_by_cell(rfm_df, max_points=200)
+    assert len(sample) < len(rfm_df)
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        thresholds = snap_thresholds(
+            Thresholds(
+                tuple(int(t) for t in np.sort(rng.integers(1, 300, 4))),
+                tuple(float(t) for t in np.sort(rng.uniform(1, 100, 4))),
+                DEFAULT_THRESHOLDS.monetary,
+            )
+        )
+        expected = set(score(rfm_df, thresholds)["Category"].unique())
+        assert set(score(sample, thresholds)["Category"].unique()) == expected
+
+
+def test_cube_size_is_bounded_as_customers_grow():
+    # Recency spans 100 days and Frequency stays below 50 days, so at most
+    # 100 x (grid points up to 50) cells whatever the number of customers
+    bound = 100 * (np.searchsorted(FREQUENCY_GRID, 50) + 1)
+    rng = np.random.default_rng(0)
+    sizes = []
+    for customers in (10_000, 100_000, 1_000_000):
+        rfm_df = pd.DataFrame(
+            {
+                "Recency": rng.integers(1, 101, customers).astype("int32"),
+                "Frequency": rng.uniform(1, 50, customers).astype("float32"),
+                "Monetary": rng.uniform(0, 1000, customers),
+                "AOS": rng.uniform(0, 100, customers).astype("float32"),
+            }
+        )
+        sizes.append(len(rfm_cube(rfm_df)))
+    assert max(sizes) <= bound
+
+
+@pytest.mark.parametrize("objective, target", [("balanced", 0.5), ("champions_revenue", 0.3)])
+def test_optimizer_returns_distinct_thresholds_with_exact_loss(transactions, objective, target):
+    cube = rfm_cube(compute_rfm(transactions))
+    thresholds, loss = optimize_thresholds(cube, objective, target, n_candidates=2000)
+    assert len(set(thresholds.recency)) == 4
+    assert len(set(thresholds.frequency)) == 4
+    assert list(thresholds.frequency) == sorted(thresholds.frequency)
+
+    # The reported loss is the loss of the returned set scored on the cube
+    totals = cube_category_totals(score_cube(cube, thresholds))
+    counts = totals["Customers"].to_numpy(dtype="float64")[None]
+    revenue = totals["Monetary"].to_numpy()[None]
+    assert OBJECTIVES[objective](counts, revenue, target)[0] == pytest.approx(loss)
+
+
+def test_migration_matrices_add_up_to_segment_sizes(transactions):
+    index = WindowIndex(transactions)
+    first, last = date_span(transactions)
+    as_of_dates = month_ends(first, last)
+    sizes, matrices = segment_migration(index, as_of_dates, start_date=first)
+    assert len(matrices) == len(as_of_dates) - 1
+
+    snapshots = segment_snapshots(index, as_of_dates, start_date=first)
+    for (_, as_of, matrix), (_, previous), (_, current) in zip(
+        matrices, snapshots, snapshots[1:]
+    ):
+        current_sizes = current.value_counts(sort=False)
+        previous_sizes = previous.value_counts(sort=False)
+        np.testing.assert_array_equal(matrix.sum(axis=0), current_sizes[matrix.columns])
+        np.testing.assert_array_equal(
+            matrix.drop(NEW_CUSTOMERS).sum(axis=1), previous_sizes[matrix.columns]
+        )
+        # Customers without a previous segment are exactly the new ids
+        assert matrix.loc[NEW_CUSTOMERS].sum() == len(current.index.difference(previous.index))
+        np.testing.assert_array_equal(sizes.loc[as_of], current_sizes[sizes.columns])
@@ -0,0 +1,38 @@
+import json
+import logging
+
+import rfm_instrument
+from rfm_instrument import Instrumentation, _timings_level
+
+
+def test_timings_level_names():
+    assert _timings_level("DEBUG") == logging.DEBUG
+    assert _timings_level("OFF") is None
+    # Unknown names must not break the apps at import
+    assert _timings_level("VERBOSE") == logging.INFO
+
+
+def test_disabled_instrumentation_records_nothing(caplog):
+    instrumentation = Instrumentation(enabled=False)
+    with caplog.at_level(logging.DEBUG, logger="rfm.timings"):
+        with instrumentation.stage("load") as record:
+            record["rows"] = 10
+    assert instrumentation.records == []
+    assert caplog.records == []
+
+
+def test_stages_are_recorded_and_logged(caplog):
+    instrumentation = Instrumentation(enabled=True)
+    try:
+        with caplog.at_level(logging.DEBUG, logger="rfm.timings"):
+            with instrumentation.stage("load") as record:
+                data = list(range(10_000))
+                record["rows"] = len(data)
+    finally:
+        instrumentation.stop()
+    (record,) = instrumentation.records
+    assert record["stage"] == "load"
+    assert record["rows"] == 10_000
+    assert record["memory_delta_mb"] >= 0
+    assert json.loads(caplog.records[-1].getMessage()) == record
+    assert caplog.records[-1].levelno == rfm_instrument.TIMINGS_LEVEL
@@ -0,0 +1,80 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from rfm_engine import compute_rfm
+from rfm_io import (
+    CACHE_SCHEMA,
+    applied_deltas,
+    build_state,
+    load_transactions,
+    read_transactions_csv,
+    rfm_from_state,
+    update_state,
+)
+
+pytest.importorskip("pyarrow")
+
+SAMPLE_CSV = os.path.join(os.path.dirname(os.path.dirname(__file__)), "rfm-data.csv")
+
+
+@pytest.fixture
+def split_history(tmp_path):
+    raw = pd.read_csv(SAMPLE_CSV).sort_values("date", kind="stable")
+    cut = len(raw) * 3 // 4
+    base_path = tmp_path / "base.csv"
+    delta_path = tmp_path / "delta.csv"
+    raw.iloc[:cut].to_csv(base_path, index=False)
+    raw.iloc[cut:].to_csv(delta_path, index=False)
+    return str(base_path), str(delta_path)
+
+
+def test_state_update_matches_full_history(tmp_path, split_history):
+    base_path, delta_path = split_history
+    state_path = str(tmp_path / "state.feather")
+    build_state(state_path, base_path)
+    update_state(state_path, delta_path)
+
+    expected = compute_rfm(read_transactions_csv(SAMPLE_CSV))
+    pd.testing.assert_frame_equal(rfm_from_state(state_path), expected)
+    assert len(applied_deltas(state_path)) == 1
+
+
+def test_state_refuses_a_delta_applied_twice(tmp_path, split_history):
+    base_path, delta_path = split_history
+    state_path = str(tmp_path / "state.feather")
+    build_state(state_path, base_path)
+    update_state(state_path, delta_path)
+    before = rfm_from_state(state_path)
+
+    # A copy with the same content is still the same delta
+    retry_path = str(tmp_path / "retry.csv")
+    with open(delta_path, "rb") as src, open(retry_path, "wb") as dst:
+        dst.write(src.read())
+    with pytest.raises(ValueError, match="already applied"):
+        update_state(state_path, retry_path)
+    pd.testing.assert_frame_equal(rfm_from_state(state_path), before)
+
+
+def test_cache_written_under_another_schema_is_rebuilt(tmp_path):
+    import pyarrow.feather as feather
+
+    cache_dir = str(tmp_path / "cache")
+    expected = load_transactions(SAMPLE_CSV, cache_dir)
+    (meta_name,) = [name for name in os.listdir(cache_dir) if name.endswith(".json")]
+    meta_path = os.path.join(cache_dir, meta_name)
+
+    # Simulate a cache from before the compact schema: wide dtypes, no marker
+    stale = expected.astype({"num_of_events": "int64", "value": "float64"})
+    feather.write_feather(stale, meta_path[: -len(".json")] + ".feather")
+    with open(meta_path, encoding="utf-8") as f:
+        metadata = json.load(f)
+    del metadata["schema"]
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(metadata, f)
+
+    pd.testing.assert_frame_equal(load_transactions(SAMPLE_CSV, cache_dir), expected)
+    with open(meta_path, encoding="utf-8") as f:
+        assert json.load(f)["schema"] == CACHE_SCHEMA
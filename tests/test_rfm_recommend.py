@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import rfm_recommend
+from rfm_engine import compute_rfm, score
+from rfm_io import read_transactions_csv
+from rfm_recommend import RecommendationError, submit_recommendation
+
+pytest.importorskip("openai")
+
+SAMPLE_CSV = os.path.join(os.path.dirname(os.path.dirname(__file__)), "rfm-data.csv")
+
+
+# Stub of the chat completions endpoint: answers with the queued status and
+# body, after the release event is set
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers["Content-Length"]))
+        server.requests.append(self.path)
+        server.release.wait(10)
+        status, body = server.responses.pop(0) if server.responses else server.default
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def completion(content):
+    return {
+        "id": "stub",
+        "object": "chat.completion",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}}],
+    }
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.requests = []
+    server.responses = []
+    server.default = (200, completion(" Champions: keep them close. "))
+    server.release = threading.Event()
+    server.release.set()
+    server.api_base = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="module")
+def scores():
+    return score(compute_rfm(read_transactions_csv(SAMPLE_CSV)))
+
+
+def test_requests_in_flight_are_joined_and_answers_cached(stub, scores, tmp_path):
+    cache_dir = str(tmp_path / "recommendations")
+    stub.release.clear()
+    first = submit_recommendation(scores, "key", stub.api_base, 5, cache_dir)
+    second = submit_recommendation(scores, "key", stub.api_base, 5, cache_dir)
+    assert second is first
+    stub.release.set()
+    assert first.result(10) == "Champions: keep them close."
+    assert stub.requests == ["/v1/chat/completions"]
+
+    # Answered from the disk cache without another request
+    cached = submit_recommendation(scores, "key", stub.api_base, 5, cache_dir)
+    assert cached.done()
+    assert cached.result() == "Champions: keep them close."
+    assert len(stub.requests) == 1
+
+
+@pytest.mark.parametrize(
+    "status, body, message",
+    [
+        (429, {"error": {"message": "quota", "type": "insufficient_quota"}}, "quota"),
+        (500, {"error": {"message": "boom", "type": "server_error"}}, "Error with OpenAI"),
+        (200, {"id": "stub", "object": "chat.completion", "choices": []}, "Unexpected"),
+    ],
+)
+def test_api_errors_become_recommendation_errors(stub, scores, tmp_path, status, body, message):
+    cache_dir = str(tmp_path / "recommendations")
+    stub.responses.append((status, body))
+    future = submit_recommendation(scores, "key", stub.api_base, 5, cache_dir)
+    with pytest.raises(RecommendationError, match=message):
+        future.result(10)
+    # Failures aren't cached, so the next visit asks again
+    assert submit_recommendation(scores, "key", stub.api_base, 5, cache_dir).result(10)
+    assert len(stub.requests) == 2
+
+
+def test_slow_endpoint_times_out(stub, scores, tmp_path):
+    stub.release.clear()
+    future = submit_recommendation(scores, "key", stub.api_base, 1, str(tmp_path))
+    with pytest.raises(RecommendationError, match="timed out"):
+        future.result(10)
+
+
+def test_finished_request_does_not_drop_a_newer_one():
+    old, new = Future(), Future()
+    rfm_recommend._pending["key"] = new
+    rfm_recommend._forget("key", old)
+    assert rfm_recommend._pending.pop("key") is new
@@ -0,0 +1,100 @@
+import gc
+import threading
+import time
+
+import pytest
+
+from rfm_store import SessionHandles, SharedStore
+
+
+def test_concurrent_first_acquire_builds_once():
+    store = SharedStore()
+    calls = []
+
+    def factory():
+        calls.append(1)
+        time.sleep(0.05)
+        return object()
+
+    start = threading.Barrier(8)
+    values = []
+
+    def session():
+        start.wait()
+        values.append(store.acquire("transactions", factory))
+
+    threads = [threading.Thread(target=session) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len({id(value) for value in values}) == 1
+    assert store.stats() == {"transactions": 8}
+
+
+def test_sessions_share_one_entry_per_key():
+    store = SharedStore()
+    first, second = SessionHandles(store), SessionHandles(store)
+    value = first.get("scores", "a", object)
+    assert second.get("scores", "a", object) is value
+    # Asking again for the held key doesn't take another reference
+    assert first.get("scores", "a", object) is value
+    assert store.stats() == {"a": 2}
+
+
+def test_moving_a_slot_releases_the_old_key():
+    store = SharedStore()
+    handles = SessionHandles(store)
+    handles.get("scores", "a", object)
+    handles.get("export", "a", object)
+    handles.get("scores", "b", object)
+    assert store.stats() == {"a": 1, "b": 1}
+    handles.get("export", "c", object)
+    assert store.stats() == {"b": 1, "c": 1}
+
+
+def test_failing_factory_leaves_no_entry():
+    store = SharedStore()
+    handles = SessionHandles(store)
+    handles.get("scores", "a", object)
+
+    def failing():
+        raise OSError("source file vanished")
+
+    with pytest.raises(OSError):
+        handles.get("scores", "b", failing)
+    # The slot keeps its previous key and nothing is stored for the new one
+    assert store.stats() == {"a": 1}
+    value = handles.get("scores", "b", lambda: "rebuilt")
+    assert value == "rebuilt"
+    assert store.stats() == {"b": 1}
+
+
+def test_close_releases_every_reference():
+    store = SharedStore()
+    handles = SessionHandles(store)
+    handles.get("transactions", "t", object)
+    handles.get("scores", "s", object)
+    handles.close()
+    assert store.stats() == {}
+    # Closing twice, or collecting a closed session, releases nothing more
+    other = SessionHandles(store)
+    other.get("scores", "s", object)
+    handles.close()
+    del handles
+    gc.collect()
+    assert store.stats() == {"s": 1}
+
+
+def test_collected_sessions_empty_the_store():
+    store = SharedStore()
+    sessions = [SessionHandles(store) for _ in range(3)]
+    for handles in sessions:
+        handles.get("transactions", "t", object)
+    sessions[0].get("scores", "s", object)
+    assert store.stats() == {"t": 3, "s": 1}
+    del sessions, handles
+    gc.collect()
+    assert store.stats() == {}